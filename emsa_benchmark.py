@@ -0,0 +1,478 @@
+#  Copyright (C) 2025 Vojtech Klapetek.
+#
+#  This program is free software; you can redistribute it and/or modify it under the terms of the GNU General Public
+#  License as published by the Free Software Foundation; either version 3 of the License, or (at your option) any
+#  later version.
+#
+#  This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied
+#  warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+#  details.
+
+# Benchmarks of the analysis engine in emsa_script.py on synthetic gels with a known background plane and known
+# bands, every run also checks the recovered plane and peak sums against that ground truth. Run from the
+# repository directory with
+#   python emsa_benchmark.py --sizes 500,1000,2000
+#   ImageJ-linux64 --headless --jython emsa_benchmark.py --sizes 10000 --repeat 1
+
+import math
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+from array import array
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import emsa_script as emsa
+
+try:
+	import tracemalloc
+except ImportError: # Python 2 / Jython
+	tracemalloc = None
+
+MAX_VALUE = 65535 # synthetic gels are 16-bit like scanner images, bands are dark before inversion
+
+
+# best wall time in seconds of several runs of function(), setup() runs untimed before every run
+def timed(function, repeat=5, setup=None):
+	best = None
+	for k in range(repeat):
+		if setup:
+			setup()
+		start = time.time()
+		function()
+		elapsed = time.time() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return best
+
+# peak bytes allocated while running function(), None where it cannot be measured
+def peak_memory(function, setup=None):
+	if setup:
+		setup()
+	if tracemalloc is not None:
+		tracemalloc.start()
+		try:
+			function()
+			return tracemalloc.get_traced_memory()[1]
+		finally:
+			tracemalloc.stop()
+	try:
+		from java.lang import Runtime, System
+	except ImportError:
+		function()
+		return None
+	runtime = Runtime.getRuntime()
+	System.gc()
+	before = runtime.totalMemory() - runtime.freeMemory()
+	function()
+	return max(0, runtime.totalMemory() - runtime.freeMemory() - before)
+
+def report(name, seconds, items, unit, memory=None):
+	line = "%-44s %10.2f ms %14.0f %s/s" % (name, seconds * 1000, items / seconds if seconds > 0 else 0, unit)
+	if memory is not None:
+		line += " %10.1f MB" % (memory / 1048576.0)
+	print(line)
+
+
+# Parameters:
+# size: width and height of the square gel in pixels
+# lane_direction: "vertical" / "horizontal"
+# plane: (a, b, c) of the background a*x + b*y + c in absolute image coordinates
+# noise: standard deviation of the gaussian pixel noise
+# lane_angle: tilt of vertical lanes in degrees as in emsa.lane_axes()
+# returns the inverted analysis image and the ground truth: lane geometry, background line placement,
+# the plane and for every lane a list of bands (start, end, amplitude) in profile coordinates
+def synthetic_gel(size, lane_count=5, lane_direction="vertical", plane=(0.01, 0.02, 500.0), noise=1.0,
+				band_count=3, seed=0, lane_angle=0.0):
+	random.seed(seed)
+	lane_sep = size // (lane_count + 1)
+	lane_width = max(4, min(50, lane_sep // 3))
+	first_x = lane_sep
+	first_y = lane_sep
+	lane_length = size - 2*lane_sep
+	bg_x, bg_sep = emsa.default_background(first_x, lane_length, lane_sep, lane_count, lane_direction)
+
+	band_length = max(2, lane_length // (4 * band_count))
+	bands = []
+	for i in range(lane_count):
+		lane_bands = []
+		for k in range(band_count):
+			start = (k + 1) * lane_length // (band_count + 1)
+			lane_bands.append((start, start + band_length, 1000.0 * (i + 1) * (k + 1)))
+		bands.append(lane_bands)
+
+	# bands are rectangles a bit wider than the sampled lane width, along the lane they cover [start, end)
+	half_width = lane_width // 2 + 3
+	boxes = [] # (x0, x1, y0, y1, amplitude) in image coordinates
+	tilted = [] # (lane, start, end, amplitude) of the bands of tilted lanes, placed row by row
+	for i in range(lane_count):
+		if lane_angle:
+			assert lane_direction == "vertical", "only vertical lanes are tilted"
+			tilted.extend((i, start, end, amplitude) for start, end, amplitude in bands[i])
+			continue
+		center = first_x + i*lane_sep if lane_direction == "vertical" else first_y + i*lane_sep
+		origin = first_y if lane_direction == "vertical" else first_x
+		for start, end, amplitude in bands[i]:
+			across = (center - half_width, center + half_width + 1)
+			along = (origin + start, origin + end)
+			if lane_direction == "vertical":
+				boxes.append(across + along + (amplitude,))
+			else:
+				boxes.append(along + across + (amplitude,))
+
+	# gaussian noise is drawn once into a pool and reused at random offsets, drawing it per pixel would
+	# dominate the generation time of the large gels
+	if noise > 0:
+		pool = [random.gauss(0.0, noise) for k in range(65536 + size)]
+	else:
+		pool = [0.0] * (65536 + size)
+	a, b, c = plane
+	pixels = array("d")
+	for y in range(size):
+		row_start = c + b*y
+		offset = random.randrange(65536)
+		row = [MAX_VALUE - (row_start + a*x) - n for x, n in zip(range(size), pool[offset:offset + size])]
+		for x0, x1, y0, y1, amplitude in boxes:
+			if y0 <= y < y1:
+				row[x0:x1] = [value - amplitude for value in row[x0:x1]]
+		for i, start, end, amplitude in tilted:
+			# distance t along lane i at this row and the lane center there
+			start_x, start_y = emsa.lane_start_offset(i, lane_sep, lane_direction, lane_angle)
+			t = (y - first_y - start_y) / math.cos(math.radians(lane_angle))
+			if start <= t < end:
+				center = first_x + start_x - t*math.sin(math.radians(lane_angle))
+				x0 = int(math.ceil(center - half_width))
+				x1 = int(math.floor(center + half_width)) + 1
+				row[x0:x1] = [value - amplitude for value in row[x0:x1]]
+		pixels.extend(row)
+
+	image = emsa.InvertedImage(emsa.PixelImage(size, size, pixels, MAX_VALUE), MAX_VALUE)
+	truth = {"first_x": first_x, "first_y": first_y, "lane_length": lane_length, "lane_sep": lane_sep,
+			"lane_width": lane_width, "lane_count": lane_count, "lane_direction": lane_direction,
+			"bg_x": bg_x, "bg_sep": bg_sep, "plane": plane, "bands": bands, "noise": noise, "lane_angle": lane_angle}
+	return image, truth
+
+# writes the pixels of a PixelImage to an uncompressed little-endian 32-bit float TIFF file, rows_per_strip
+# rows per strip
+def write_tiff(path, image, rows_per_strip=16):
+	width, height = image.width, image.height
+	row_size = 4 * width
+	offsets = [8 + y * row_size for y in range(0, height, rows_per_strip)]
+	byte_counts = [min(rows_per_strip, height - y) * row_size for y in range(0, height, rows_per_strip)]
+	ifd = 8 + height * row_size
+	# (tag, type, values), arrays of more than one value follow the directory
+	entries = [(256, 4, [width]), (257, 4, [height]), (258, 3, [32]), (259, 3, [1]), (262, 3, [1]),
+			(273, 4, offsets), (277, 3, [1]), (278, 4, [rows_per_strip]), (279, 4, byte_counts), (339, 3, [3])]
+	extra = ifd + 2 + 12 * len(entries) + 4
+	directory = struct.pack("<H", len(entries))
+	arrays = b""
+	for tag, field_type, values in entries:
+		fmt = "<" + {3: "H", 4: "I"}[field_type] * len(values)
+		if len(values) == 1:
+			data = struct.pack(fmt, *values).ljust(4, b"\0")
+		else:
+			data = struct.pack("<I", extra + len(arrays))
+			arrays += struct.pack(fmt, *values)
+		directory += struct.pack("<HHI", tag, field_type, len(values)) + data
+	pixels = array("f", image.pixels)
+	if sys.byteorder != "little":
+		pixels.byteswap()
+	f = open(path, "wb")
+	try:
+		f.write(struct.pack("<2sHI", b"II", 42, ifd))
+		f.write(pixels.tobytes() if hasattr(pixels, "tobytes") else pixels.tostring())
+		f.write(directory + struct.pack("<I", 0) + arrays)
+	finally:
+		f.close()
+
+# the plane in the coordinates used by fit_plane(), y relative to the top of the background lines
+def relative_plane(truth):
+	a, b, c = truth["plane"]
+	if truth["lane_direction"] == "vertical":
+		y_origin = truth["first_y"]
+	else:
+		y_origin = truth["first_y"] - 0.5*truth["lane_width"]
+	return a, b, c + b*y_origin
+
+# sampling is nearest pixel, so even lane widths and the half pixel start of horizontal background lines
+# shift the sampled background by up to half a pixel
+def half_pixel_error(truth):
+	return 0.5 * (abs(truth["plane"][0]) + abs(truth["plane"][1]))
+
+def check_plane(truth, plane):
+	expected = relative_plane(truth)
+	# compare the planes where the lanes are, the coefficients themselves are poorly conditioned for noisy data
+	tolerance = 1e-6 * abs(expected[2]) + half_pixel_error(truth) + truth["noise"]
+	for x in [truth["first_x"], truth["first_x"] + truth["lane_count"] * truth["lane_sep"]]:
+		for y in [0, truth["lane_length"]]:
+			difference = (plane[0] - expected[0])*x + (plane[1] - expected[1])*y + plane[2] - expected[2]
+			assert abs(difference) <= tolerance, ("plane", plane, expected, x, y)
+
+def check_sums(truth, sums, selections):
+	noise = truth["noise"]
+	slope = 2 * half_pixel_error(truth) # from the lanes and from the fitted plane
+	for i in range(truth["lane_count"]):
+		for k in range(len(selections)):
+			left, right = selections[k]
+			expected = 0.0
+			edges = 0.0
+			for start, end, amplitude in truth["bands"][i]:
+				expected += amplitude * max(0, min(end, right) - max(start, left))
+				# the bands of tilted lanes start and end on whole pixel rows, up to half a row from their
+				# position along the lane
+				if truth.get("lane_angle") and min(end, right) > max(start, left):
+					edges += amplitude
+			rows = right - left
+			tolerance = 1e-6 * (1.0 + abs(expected)) + rows * slope + noise * (rows + 6*math.sqrt(rows)) + edges
+			assert abs(sums[i][k] - expected) <= tolerance, ("peak sum", i, k, sums[i][k], expected)
+
+def check_lanes(truth, lanes):
+	first = "first_x" if truth["lane_direction"] == "vertical" else "first_y"
+	assert lanes is not None, ("lanes", "not detected")
+	found = (lanes["lane_count"], lanes[first], lanes["lane_sep"])
+	expected = (truth["lane_count"], truth[first], truth["lane_sep"])
+	assert found[0] == expected[0] and abs(found[1] - expected[1]) <= 1 and abs(found[2] - expected[2]) <= 1, \
+		("lanes", found, expected)
+
+# one selection area per band plus the whole lane
+def band_selections(truth):
+	selections = [[start - 2, end + 2] for start, end, amplitude in truth["bands"][0]]
+	return selections + [[0, truth["lane_length"]]]
+
+
+def bench_pipeline(size, lane_count, lane_direction, noise, repeat):
+	start = time.time()
+	image, truth = synthetic_gel(size, lane_count, lane_direction, noise=noise)
+	print("%s gel %dx%d, %d lanes (generated in %.1f s)" % (lane_direction, size, size, lane_count,
+															time.time() - start))
+
+	first_x, first_y, lane_length = truth["first_x"], truth["first_y"], truth["lane_length"]
+	lane_sep, lane_width, bg_x, bg_sep = truth["lane_sep"], truth["lane_width"], truth["bg_x"], truth["bg_sep"]
+	selections = band_selections(truth)
+	clear = emsa.PROFILE_CACHE.clear
+
+	analyze = lambda: emsa.lane_profiles(first_x, first_y, lane_length, lane_sep, lane_width, lane_count,
+										lane_direction, image)
+	background = lambda: emsa.extract_background(bg_x, bg_sep, first_y, lane_length, lane_direction, lane_count,
+												lane_sep, lane_width, image)
+	lines = emsa.background_lines(bg_x, bg_sep, first_y, lane_length, lane_direction, lane_count, lane_sep, lane_width)
+	columns = dict((x, emsa.line_profile(image, *line)) for x, line in lines.items())
+
+	profiles = analyze()
+	plane = emsa.fit_plane(columns)
+	remove = lambda: emsa.subtract_background(profiles, plane[0], plane[1], plane[2], first_x, lane_sep,
+											lane_width, lane_direction)
+	adj_profiles = remove()
+	sum_profiles = lambda: emsa.measure_selections(emsa.prefix_sums(adj_profiles), selections)
+
+	detect = lambda: emsa.detect_lanes(image, lane_direction)
+	check_lanes(truth, detect())
+	check_plane(truth, background())
+	result = emsa.measure_gel(image, first_x, first_y, lane_length, lane_sep, lane_width, lane_count, lane_direction,
+							bg_x, bg_sep, selections)
+	check_sums(truth, result["sums"], selections)
+	detect_bands = lambda: emsa.detect_bands(result["adj_profiles"])
+	areas = detect_bands()
+	assert len(areas) == len(truth["bands"][0]), ("bands", areas, truth["bands"][0])
+	check_sums(truth, emsa.measure_selections(result["adj_prefix_sums"], areas), areas)
+
+	y_origin = emsa.plane_origin(first_y, lane_width, lane_direction)
+	build_table = lambda: emsa.SummedAreaTable(image, result["plane"], y_origin)
+	table = build_table()
+	boxes = emsa.lane_boxes(first_x, first_y, lane_sep, lane_width, lane_count, lane_direction, selections)
+	box_sums = lambda: emsa.measure_boxes(table, boxes)
+	check_sums(truth, [[value / lane_width for value in lane] for lane in box_sums()], selections)
+
+	# measuring again from the on-disk cache, as when a gel gets new selection areas
+	cache_dir = tempfile.mkdtemp(prefix="emsa_cache")
+	cache = emsa.ResultCache(cache_dir)
+	measure_cached = lambda: emsa.measure_gel(image, first_x, first_y, lane_length, lane_sep, lane_width, lane_count,
+											lane_direction, bg_x, bg_sep, selections, cache=cache)
+	clear()
+	measure_cached()
+	check_sums(truth, measure_cached()["sums"], selections)
+
+	# a two slice stack, the second slice is a copy of the gel with a brighter background
+	copy = emsa.PixelImage(size, size, array("d", image.image.pixels), MAX_VALUE)
+	stack = [image, emsa.InvertedImage(copy, MAX_VALUE + 100.0)]
+	measure_stack = lambda: emsa.measure_stack(stack, first_x, first_y, lane_length, lane_sep, lane_width, lane_count,
+											lane_direction, bg_x, bg_sep, selections)
+	for slice_result in measure_stack():
+		check_sums(truth, slice_result["sums"], selections)
+
+	# the gel saved as a float TIFF in 16 row strips, measured memory-mapped and fully decoded
+	file_dir = tempfile.mkdtemp(prefix="emsa_gel")
+	gel_path = os.path.join(file_dir, "gel.tif")
+	write_tiff(gel_path, image.image)
+	def measure_file(load):
+		image = load()
+		return emsa.measure_gel(image, first_x, first_y, lane_length, lane_sep, lane_width, lane_count,
+								lane_direction, bg_x, bg_sep, selections)
+	def decoded():
+		pixels = emsa.read_tiff(gel_path)
+		return emsa.InvertedImage(pixels, pixels.max_value)
+	measure_mapped = lambda: measure_file(lambda: emsa.load_image(gel_path))
+	measure_decoded = lambda: measure_file(decoded)
+	mapped_sums = measure_mapped()["sums"]
+	check_sums(truth, mapped_sums, selections)
+	assert mapped_sums == measure_decoded()["sums"], "mapped and decoded sums differ"
+
+	lane_pixels = lane_count * (lane_length + 1) * lane_width
+	column_pixels = sum(len(column) for column in columns.values())
+	samples = lane_count * (lane_length + 1)
+	stages = [("detect_lanes (projection + period)", detect, size * size, "px", None),
+			("analyze (lane sampling)", analyze, lane_pixels, "px", clear),
+			("extract_background (sampling + fit)", background, column_pixels, "px", clear),
+			("fit_plane", lambda: emsa.fit_plane(columns), column_pixels, "px", None),
+			("removeBackground (subtraction)", remove, samples, "px", None),
+			("sumProfiles (%d areas)" % len(selections), sum_profiles, samples, "px", None),
+			("detect_bands (%d lanes)" % lane_count, detect_bands, samples, "px", None),
+			("SummedAreaTable (build)", build_table, size * size, "px", None),
+			("measure_boxes (%d boxes)" % (lane_count * len(selections)), box_sums, lane_count * len(selections),
+			"box", None),
+			("measure_gel from the result cache", measure_cached, samples, "px", clear),
+			("measure_stack (%d slices)" % len(stack), measure_stack, len(stack) * lane_pixels, "px", clear),
+			("measure_gel from a decoded file", measure_decoded, lane_pixels, "px", clear),
+			("measure_gel from a memory-mapped file", measure_mapped, lane_pixels, "px", clear)]
+	try:
+		for name, function, items, unit, setup in stages:
+			seconds = timed(function, repeat, setup)
+			report(name, seconds, items, unit, peak_memory(function, setup))
+	finally:
+		shutil.rmtree(cache_dir, ignore_errors=True)
+		shutil.rmtree(file_dir, ignore_errors=True)
+	print("")
+
+
+# per-pixel loop used by removeBackground before the bulk subtraction, kept as a reference, it evaluates the plane
+# of vertical lanes at absolute y while the plane is fitted at y relative to first_y, so its vertical lane
+# samples are b*first_y lower than those of subtract_background()
+def loop_subtract_background(profiles, a, b, c, first_x, first_y, lane_length, lane_sep, lane_width, lane_direction):
+	adj_profiles = []
+	for i in range(len(profiles)):
+		values = list(profiles[i])
+		for j in range(lane_length):
+			if lane_direction == "vertical":
+				x = first_x + i*lane_sep
+				y = first_y + j
+			else:
+				y = i*lane_sep + 0.5*lane_width
+				x = first_x + j
+			values[j] = values[j] - (a*x + b*y + c)
+		adj_profiles.append(values)
+	return adj_profiles
+
+def bench_subtract_background(lane_count=24, lane_length=10000):
+	random.seed(0)
+	profiles = [[random.random() * 255 for j in range(lane_length + 1)] for i in range(lane_count)]
+	a, b, c = 0.013, -0.021, 17.5
+	pixels = lane_count * lane_length
+
+	for lane_direction in ["vertical", "horizontal"]:
+		loop = lambda: loop_subtract_background(profiles, a, b, c, 815, 50, lane_length, 165, 50, lane_direction)
+		bulk = lambda: emsa.subtract_background(profiles, a, b, c, 815, 165, 50, lane_direction)
+
+		expected = loop()
+		result = bulk()
+		offset = b*50 if lane_direction == "vertical" else 0.0
+		for i in range(lane_count):
+			for j in range(lane_length):
+				assert abs(result[i][j] - expected[i][j] - offset) < 1e-6, (lane_direction, i, j)
+
+		report("subtract_background loop (%s)" % lane_direction, timed(loop), pixels, "px")
+		report("subtract_background bulk (%s)" % lane_direction, timed(bulk), pixels, "px")
+
+def bench_peak_sums(lane_count=24, lane_length=10000, area_count=10):
+	random.seed(0)
+	profiles = [[random.random() * 255 for j in range(lane_length + 1)] for i in range(lane_count)]
+	selections = [sorted(random.sample(range(lane_length), 2)) for k in range(area_count)]
+	prefixes = emsa.prefix_sums(profiles)
+	queries = lane_count * area_count
+
+	slices = lambda: [[sum(profile[left:right]) for left, right in selections] for profile in profiles]
+	lookups = lambda: emsa.measure_selections(prefixes, selections)
+
+	expected = slices()
+	result = lookups()
+	for i in range(lane_count):
+		for k in range(area_count):
+			assert abs(result[i][k] - expected[i][k]) < 1e-6 * max(1.0, abs(expected[i][k])), (i, k)
+
+	report("prefix_sums", timed(lambda: emsa.prefix_sums(profiles)), lane_count * lane_length, "px")
+	report("peak sums by slicing", timed(slices), queries, "areas")
+	report("peak sums by prefix lookup", timed(lookups), queries, "areas")
+
+
+# display decimation of the profiles plotted in the windows, checked to keep every extreme of the profiles
+def bench_decimation(lane_count=24, lane_length=10000, width=530):
+	random.seed(0)
+	profiles = [[random.random() * 255 for j in range(lane_length + 1)] for i in range(lane_count)]
+	decimate = lambda: [emsa.decimate_profile(profile, width) for profile in profiles]
+	for profile, (xs, ys) in zip(profiles, decimate()):
+		assert len(xs) <= 2 * width and xs == sorted(xs), len(xs)
+		assert max(ys) == max(profile) and min(ys) == min(profile)
+		assert all(profile[int(x)] == y for x, y in zip(xs, ys))
+	report("decimate_profile (%d points each)" % (2 * width), timed(decimate), lane_count * lane_length, "px")
+
+
+# tilted lanes sampled through a LaneGrid against the straight lanes of the same gel
+def bench_tilted_lanes(size, lane_count, noise, repeat, lane_angle):
+	image, truth = synthetic_gel(size, lane_count, "vertical", noise=noise, lane_angle=lane_angle)
+	print("vertical gel %dx%d, %d lanes tilted by %g degrees" % (size, size, lane_count, lane_angle))
+	first_x, first_y, lane_length = truth["first_x"], truth["first_y"], truth["lane_length"]
+	lane_sep, lane_width = truth["lane_sep"], truth["lane_width"]
+	selections = band_selections(truth)
+
+	result = emsa.measure_gel(image, first_x, first_y, lane_length, lane_sep, lane_width, lane_count, "vertical",
+							truth["bg_x"], truth["bg_sep"], selections, lane_angle=lane_angle)
+	check_sums(truth, result["sums"], selections)
+
+	def clear():
+		emsa.PROFILE_CACHE.clear()
+		emsa.GRID_CACHE.clear()
+	straight = lambda: emsa.lane_profiles(first_x, first_y, lane_length, lane_sep, lane_width, lane_count, "vertical",
+										image)
+	tilted = lambda: emsa.lane_profiles(first_x, first_y, lane_length, lane_sep, lane_width, lane_count, "vertical",
+										image, lane_angle)
+	build = lambda: emsa.LaneGrid(lane_length, lane_width, "vertical", lane_angle)
+	lane_pixels = lane_count * (lane_length + 1) * lane_width
+	report("lane_profiles straight", timed(straight, repeat, clear), lane_pixels, "px")
+	report("lane_profiles tilted (grid reused)", timed(tilted, repeat, emsa.PROFILE_CACHE.clear), lane_pixels, "px")
+	report("LaneGrid build", timed(build, repeat), (lane_length + 1) * lane_width, "px")
+	print("")
+
+
+def main(argv):
+	import argparse
+	parser = argparse.ArgumentParser(prog="emsa_benchmark.py",
+									description="Times the analysis stages on synthetic gels and checks the results "
+												"against the known plane and bands.")
+	parser.add_argument("--sizes", default="500,1000,2000",
+						help="comma separated gel sizes in pixels, e.g. 500,2000,10000 (default: %(default)s)")
+	parser.add_argument("--lanes", type=int, default=5, help="lane count (default: %(default)s)")
+	parser.add_argument("--direction", choices=["vertical", "horizontal", "both"], default="both")
+	parser.add_argument("--noise", type=float, default=1.0, help="pixel noise standard deviation (default: %(default)s)")
+	parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage, the best is reported")
+	parser.add_argument("--angle", type=float, default=1.0,
+						help="tilt of the lanes in the tilted lane benchmark, 0 skips it (default: %(default)s)")
+	parser.add_argument("--no-micro", action="store_true", help="skip the subtraction, peak sum and plot decimation micro benchmarks")
+	args = parser.parse_args(argv)
+
+	directions = ["vertical", "horizontal"] if args.direction == "both" else [args.direction]
+	for size in [int(size) for size in args.sizes.split(",")]:
+		for lane_direction in directions:
+			bench_pipeline(size, args.lanes, lane_direction, args.noise, args.repeat)
+		if args.angle:
+			bench_tilted_lanes(size, args.lanes, args.noise, args.repeat, args.angle)
+	if not args.no_micro:
+		bench_subtract_background()
+		bench_peak_sums()
+		bench_decimation()
+	return 0
+
+
+if __name__ in ("__main__", "__builtin__"):
+	sys.exit(main(sys.argv[1:]))
@@ -10,19 +10,143 @@
 #  warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
 #  details.
 
-from ij import IJ, ImagePlus, ImageListener
-from ij.gui import RoiListener, Roi, Line, ProfilePlot, Plot
-from ij.plugin import ContrastEnhancer
-from ij.io import SaveDialog
-from javax.swing import JFrame, JPanel, JButton, JOptionPane, JLabel, JTextField, BorderFactory, JTextPane, JRadioButton, ButtonGroup, JComboBox, JTextArea
-from java.awt import GridBagLayout, GridBagConstraints as GBC
-from javax.swing.event import DocumentListener
-from java.awt.event import ActionListener, ItemListener, ItemEvent
-from java.lang import RuntimeException
+import functools
+import hashlib
+import json
+import math
+import operator
+import os
+import struct
+import sys
+import threading
+import time
+import uuid
+from array import array
+from collections import OrderedDict
+from itertools import count
+
+try:
+	from ij import IJ, ImagePlus, ImageListener
+	from ij.gui import RoiListener, Roi, Line, ProfilePlot, Plot, PlotWindow, Overlay, PolygonRoi
+	from ij.plugin import ContrastEnhancer, Colors
+	from ij.process import FloatPolygon, ByteProcessor, ShortProcessor, FloatProcessor, ColorProcessor
+	from ij.io import SaveDialog, OpenDialog
+	from javax.swing import JFrame, JPanel, JButton, JOptionPane, JLabel, JTextField, BorderFactory, JTextPane, JRadioButton, ButtonGroup, JComboBox, JTextArea
+	from javax.swing import JCheckBox, SwingWorker, Timer
+	from java.awt import GridBagLayout, GridBagConstraints as GBC, Color
+	from javax.swing.event import DocumentListener
+	from java.awt.event import ActionListener, ItemListener, ItemEvent
+	from java.lang import RuntimeException
+	from java.util.concurrent import ExecutionException
+except ImportError: # plain CPython, only the headless engine (see measure_gel()) is usable
+	IJ = None
+	class DocumentListener(object): pass
+	class ActionListener(object): pass
+	class ItemListener(object): pass
+	class SwingWorker(object): pass
+
+try:
+	import tracemalloc
+except ImportError: # Jython, the used heap of the JVM is read instead (see used_memory())
+	tracemalloc = None
 
 # partly based on matplotlib Set1 color scheme
 COLORS = ["blue", "green", "red", "orange", "magenta", "#ffff33", "#a65628", "#f781bf", "#999999"]
 
+ANALYSIS_DEFAULTS = {"First lane x": 815, "First lane y": 50, "Lane length": 950,
+					"Lane separation": 165, "Lane width": 50, "Lane count": 5, "Lane angle": 0, "Lane bend": ""}
+# lane geometry parameters and the titles of their fields in the lane selection window
+GEOMETRY_FIELDS = [("first_x", "First lane x"), ("first_y", "First lane y"), ("lane_length", "Lane length"),
+					("lane_sep", "Lane separation"), ("lane_width", "Lane width"), ("lane_count", "Lane count")]
+
+
+# wall time, call count and bytes allocated of the pipeline stages, recorded only while enabled (with
+# --stage-stats or the "Record stage timings" checkbox), the time and memory of a stage include the stages it calls
+class StageStats(object):
+	def __init__(self):
+		self.enabled = False
+		self.trace_memory = False
+		self.stages = OrderedDict() # stage name -> [calls, seconds, bytes or None where unknown]
+		self.lock = threading.Lock() # stages run on lane threads and SwingWorkers
+	
+	# trace_memory: in CPython trace the allocations with tracemalloc from now on, which slows the analysis down
+	#               several times, so the times are not representative then (Jython always reads the used heap)
+	def enable(self, enabled=True, trace_memory=False):
+		self.enabled = enabled
+		self.trace_memory = enabled and trace_memory
+		if enabled and trace_memory and tracemalloc is not None and not tracemalloc.is_tracing():
+			tracemalloc.start()
+	
+	def record(self, name, seconds, allocated, calls=1):
+		with self.lock:
+			totals = self.stages.setdefault(name, [0, 0.0, None])
+			totals[0] += calls
+			totals[1] += seconds
+			if allocated is not None:
+				totals[2] = (totals[2] or 0) + allocated
+	
+	# adds the summary() recorded by another process, e.g. by a batch worker
+	def merge(self, summary):
+		for entry in summary:
+			self.record(entry["stage"], entry["seconds"], entry["bytes"], entry["calls"])
+	
+	def clear(self):
+		with self.lock:
+			self.stages.clear()
+	
+	# the stages as JSON-serializable dicts in the order they first ran
+	def summary(self):
+		with self.lock:
+			return [{"stage": name, "calls": calls, "seconds": seconds, "bytes": allocated}
+					for name, (calls, seconds, allocated) in self.stages.items()]
+	
+	# table of the stages for the ImageJ Log or the console
+	def report(self):
+		lines = ["%-24s %8s %12s %12s %10s" % ("Stage", "Calls", "Total ms", "Mean ms", "MB")]
+		for entry in self.summary():
+			memory = "%10.1f" % (entry["bytes"] / 1048576.0) if entry["bytes"] is not None else "%10s" % "-"
+			lines.append("%-24s %8d %12.1f %12.2f %s" % (entry["stage"], entry["calls"], entry["seconds"] * 1000,
+														entry["seconds"] * 1000 / entry["calls"], memory))
+		return "\n".join(lines)
+	
+	def save(self, path):
+		stats = {"platform": sys.platform, "version": sys.version, "cpus": cpu_count(), "lane_threads": LANE_THREADS,
+				"stages": self.summary()}
+		write_file(path, json.dumps(stats, indent=1))
+
+STAGE_STATS = StageStats()
+
+# bytes currently allocated, traced by tracemalloc in CPython and the used heap in Jython, None when unknown
+def used_memory():
+	if tracemalloc is not None:
+		return tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+	try:
+		from java.lang import Runtime
+	except ImportError:
+		return None
+	runtime = Runtime.getRuntime()
+	return runtime.totalMemory() - runtime.freeMemory()
+
+# decorator recording every call of a function as the stage name in STAGE_STATS, the bytes are the growth of
+# used_memory() (allocations of concurrent threads included, in Jython reduced by garbage collections meanwhile)
+def stage(name):
+	def decorate(function):
+		@functools.wraps(function)
+		def timed(*args, **kwargs):
+			if not STAGE_STATS.enabled:
+				return function(*args, **kwargs)
+			memory = used_memory()
+			start = time.time()
+			try:
+				return function(*args, **kwargs)
+			finally:
+				seconds = time.time() - start
+				allocated = used_memory()
+				allocated = max(0, allocated - memory) if None not in (allocated, memory) else None
+				STAGE_STATS.record(name, seconds, allocated)
+		return timed
+	return decorate
+
 
 class FieldListener(DocumentListener, ActionListener):
 	def __init__(self, textfields, frame):
@@ -36,18 +160,55 @@ class FieldListener(DocumentListener, ActionListener):
 		self.lane_sep = None
 		self.lane_width = None
 		self.lane_count = None
+		self.lane_angle = 0.0
+		self.lane_bend = []
+		self.preview_lines = [] # black lines (x1, y1, x2, y2) of the current step drawn over the lanes
 		
-		imp = IJ.getImage()
-		ip = imp.getProcessor().convertToRGB()
-		self.imp = ImagePlus("Lane overview", ip)
-		self.orig_ip = self.imp.getProcessor().duplicate()
-		
-		analysis_ip = ip.duplicate()
-		analysis_ip.invert()
-		self.analysis_imp = ImagePlus("Analysis", analysis_ip)
+		self.source_imp = IJ.getImage()
+		# the images are set up before stage timings can be switched on, so this setImages() is always timed and
+		# added to the timings once they are, see recordStages()
+		memory = used_memory()
+		start = time.time()
+		self.setImages(False)
+		allocated = used_memory()
+		self.first_images = (time.time() - start,
+							max(0, allocated - memory) if None not in (allocated, memory) else None)
+		self.imp = ImagePlus("Lane overview", self.preview_ip)
+		# the cursor position and ROI tools of the overview show full resolution pixels like the fields
+		calibration = self.imp.getCalibration()
+		calibration.pixelWidth = self.preview_scale
+		calibration.pixelHeight = self.preview_scale
+		calibration.setUnit("pixel")
+		self.overlay = Overlay()
+		self.imp.setOverlay(self.overlay)
+		self.preview_renderer = PreviewRenderer(self.drawPreview, self.showPreview)
+		self.result_cache = ResultCache() # lane profiles of gels analysed in earlier sessions
+		self.task = None # AnalysisTask sampling the lanes
+		self.detect_task = None # AnalysisTask detecting the lanes
+		self.recipe = None # complete parameter set replayed by "Apply recipe" until its selection areas are set
 		
 		self.imp.show()
 		
+	# native: keep the bit depth of the gel and share its pixels, sampled profiles are inverted lazily,
+	# otherwise the gel is converted to RGB and an inverted copy is analysed
+	# the lane overview shows a downsampled copy of large gels, see preview_image()
+	# the pixels of the displayed slice are wrapped in a processor of their own, the processor of source_imp gets
+	# the pixels of another slice when the user scrolls through a stack, which must not change the analysed pixels
+	@stage("setImages")
+	def setImages(self, native):
+		shown_ip = self.source_imp.getProcessor()
+		ip = self.source_imp.getStack().getProcessor(self.source_imp.getCurrentSlice())
+		if ip.getBitDepth() != 24:
+			ip.setMinAndMax(shown_ip.getMin(), shown_ip.getMax()) # display range of the overview
+		if native:
+			self.analysis_imp = InvertedImage(ImagePlus("Analysis", ip), inversion_max(ip))
+		else:
+			ip = ip.convertToRGB() # never drawn on, lanes and lines are shown as an overlay
+			self.analysis_imp = analysis_image(ip)
+		self.preview_ip, self.preview_scale = preview_image(ip)
+		self.native = native
+		self.contrast_enhanced = False
+	
 	def updateFields(self):
 		try:
 			first_x = int(self.textfields["First lane x"].getText())
@@ -56,6 +217,8 @@ class FieldListener(DocumentListener, ActionListener):
 			lane_sep = int(self.textfields["Lane separation"].getText())
 			lane_width = int(self.textfields["Lane width"].getText())
 			lane_count = int(self.textfields["Lane count"].getText())
+			lane_angle = float(self.textfields["Lane angle"].getText())
+			lane_bend = parse_bend(self.textfields["Lane bend"].getText())
 		except Exception:
 			return
 			
@@ -65,47 +228,159 @@ class FieldListener(DocumentListener, ActionListener):
 		self.lane_sep = lane_sep
 		self.lane_width = lane_width
 		self.lane_count = lane_count
+		self.lane_angle = lane_angle
+		self.lane_bend = lane_bend
 
+	# redraws the lane overview, rendering is debounced and done off the event dispatch thread
 	def lanePreview(self):
-		if self.contrast_enhanced:
-			ip = self.enhanced_ip.duplicate()
-		else:
-			ip = self.orig_ip.duplicate()
-
+		self.preview_renderer.request()
+	
+	# returns the lane outlines and the black lines of the current step as overlay ROIs, the full resolution
+	# coordinates are scaled to the lane overview
+	@stage("drawPreview")
+	def drawPreview(self):
+		scale = 1.0 / self.preview_scale
+		rois = []
 		for i in range(self.lane_count):
-			if self.lane_dir == "vertical":
-				roi = Line(self.first_x + i * self.lane_sep, self.first_y,
-							self.first_x + i * self.lane_sep, self.first_y + self.lane_length)
-			else:
-				roi = Line(self.first_x, self.first_y + i * self.lane_sep,
-							self.first_x + self.lane_length, self.first_y + i * self.lane_sep)
-			
-			roi.setStrokeWidth(self.lane_width)
+			xs, ys = lane_outline(i, self.first_x, self.first_y, self.lane_length, self.lane_sep, self.lane_width,
+								self.lane_dir, self.lane_angle, self.lane_bend)
+			roi = PolygonRoi(FloatPolygon(array("f", [x * scale for x in xs]), array("f", [y * scale for y in ys])),
+							Roi.POLYGON)
+			roi.setStrokeColor(Colors.decode(COLORS[i % len(COLORS)], Color.black))
+			roi.setStrokeWidth(5)
+			rois.append(roi)
+
+		for x1, y1, x2, y2 in self.preview_lines:
+			roi = Line(x1 * scale, y1 * scale, x2 * scale, y2 * scale)
+			roi.setStrokeWidth(5)
+			roi.setStrokeColor(Color.black)
+			rois.append(roi)
 
-			roi = roi.getPolygon()   # draw as polygon to get rectangle shape instead of line
-			ip.setColor(COLORS[i % len(COLORS)])    # (which would have round ends)
-			ip.setLineWidth(5)
-			ip.drawPolygon(roi)
+		return rois
 
-		self.imp.setProcessor(ip)
+	# replaces the shapes of the overlay in place, the image pixels are never touched
+	@stage("showPreview")
+	def showPreview(self, rois):
+		self.overlay.clear()
+		for roi in rois:
+			self.overlay.add(roi)
+		self.imp.draw()
 
 
+	# samples the lanes on an AnalysisTask, clicking the button again while it runs cancels it
 	def runAnalysis(self, event):
-		self.plot, self.plvalues = analyze(self.first_x, self.first_y, self.lane_length,
-											self.lane_sep, self.lane_width, self.lane_count,
-											self.lane_dir, self.analysis_imp)
+		if self.task is not None and not self.task.isDone():
+			self.task.cancel(False)
+			return
+		args = (self.first_x, self.first_y, self.lane_length, self.lane_sep, self.lane_width, self.lane_count,
+				self.lane_dir, self.analysis_imp, self.lane_angle, self.lane_bend, self.result_cache)
+		self.task = AnalysisTask("Sampling lanes", lambda progress: analyze(*args, progress=progress),
+								self.showAnalysis, self.analysis_button, self.dropRecipe)
+		self.task.execute()
+	
+	# stops replaying the recipe when a step it runs is cancelled or fails, or the user goes back, so that the
+	# next steps started by hand take the values of the windows again
+	def dropRecipe(self):
+		self.recipe = None
+	
+	# called on the event dispatch thread with the result of analyze()
+	def showAnalysis(self, result):
+		self.plot, self.plvalues = result
 		self.plotWindow = self.plot.show()
 		self.plot.savePlotObjects()
 		
 		background_window(self.frame, self)
 		
+	# detects the lanes on an AnalysisTask, clicking the button again while it runs cancels it
+	def detectLanes(self, event):
+		if self.detect_task is not None and not self.detect_task.isDone():
+			self.detect_task.cancel(False)
+			return
+		imp, lane_dir, cache = self.analysis_imp, self.lane_dir, self.result_cache
+		self.detect_task = AnalysisTask("Detecting lanes", lambda progress: detect_lanes(imp, lane_dir, cache, progress),
+										self.showLanes, self.detect_button)
+		self.detect_task.execute()
+	
+	# called on the event dispatch thread with the result of detect_lanes(), fills the geometry fields with the
+	# lanes found in the gel, the fields along the lanes are kept
+	def showLanes(self, lanes):
+		if self.panel.getParent() is None: # the frame shows another step
+			return
+		if lanes is None:
+			IJ.showMessage("Lane detection", "No regularly spaced lanes were found, please place the lanes by hand.")
+			return
+		for name, title in GEOMETRY_FIELDS:
+			if name in lanes:
+				self.textfields[title].setText(str(lanes[name]))
+	
+	# path of the opened gel file, None for images that were not opened from a file
+	def gelPath(self):
+		info = self.source_imp.getOriginalFileInfo()
+		if info is None or not info.directory or not info.fileName:
+			return None
+		return os.path.join(info.directory, info.fileName)
+	
+	# function listens to "Apply recipe" button, replays the recipe saved next to the gel (or one picked by hand):
+	# the lane selection is filled in and the background and measurement steps are run with the recipe values
+	def applyRecipe(self, event):
+		path = self.gelPath()
+		if path is not None and os.path.exists(recipe_path(path)):
+			path = recipe_path(path)
+		else:
+			open_dialog = OpenDialog("Apply recipe")
+			if open_dialog.getFileName() is None:
+				return
+			path = os.path.join(open_dialog.getDirectory(), open_dialog.getFileName())
+		try:
+			params, settings = load_recipe(path)
+		except (IOError, ValueError) as e:
+			IJ.showMessage("Apply recipe", "The recipe could not be read: " + str(e))
+			return
+		params = complete_parameters(params)
+		
+		if settings["native"] != self.native:
+			self.native_checkbox.setSelected(settings["native"])
+			self.setImages(settings["native"])
+			self.imp.setProcessor(self.preview_ip)
+		if settings["contrast_enhanced"]:
+			self.enhanceContrast(None)
+		elif self.contrast_enhanced: # back to the overview as it is
+			self.contrast_enhanced = False
+			self.imp.setProcessor(self.preview_ip)
+		self.direction_buttons[params["lane_direction"]].doClick()
+		for name, title in GEOMETRY_FIELDS:
+			self.textfields[title].setText(str(params[name]))
+		self.textfields["Lane angle"].setText(str(params["lane_angle"]))
+		self.textfields["Lane bend"].setText(", ".join(str(value) for value in params["lane_bend"]))
+		
+		self.recipe = params
+		self.runAnalysis(None)
+	
 	def enhanceContrast(self, event):
 		self.contrast_enhanced = True
-		self.enhanced_ip = self.orig_ip.duplicate()
+		self.enhanced_ip = self.preview_ip.duplicate()
 		enhancer = ContrastEnhancer()
 		enhancer.equalize(self.enhanced_ip)
 		
-		self.lanePreview()
+		self.imp.setProcessor(self.enhanced_ip)
+	
+	# this function listens to the "Keep native bit depth" check box
+	def switchBitDepth(self, event):
+		self.setImages(event.getSource().isSelected())
+		self.imp.setProcessor(self.preview_ip)
+	
+	# starts recording the stage timings from scratch, the timings recorded so far are logged when it is stopped,
+	# the first recording starts with the setImages() of the opened gel
+	def recordStages(self, event):
+		if event.getSource().isSelected():
+			STAGE_STATS.clear()
+			STAGE_STATS.enable()
+			if self.first_images is not None:
+				STAGE_STATS.record("setImages", *self.first_images)
+				self.first_images = None
+		else:
+			STAGE_STATS.enable(False)
+			IJ.log(STAGE_STATS.report())
 
 	# following three functions listen to changes in text fields checked by updateFields()
 	def changedUpdate(self, event):
@@ -130,6 +405,92 @@ class FieldListener(DocumentListener, ActionListener):
 		self.lanePreview()
 		
 
+# coalesces bursts of preview requests (typing "950" fires three document events) into one render after delay ms
+# without further edits, the render runs on a SwingWorker and its frame is published only if no newer request came
+class PreviewRenderer(ActionListener):
+	def __init__(self, render, publish, delay=150):
+		self.render = render
+		self.publish = publish
+		self.generation = 0
+		self.timer = Timer(delay, self)
+		self.timer.setRepeats(False)
+	
+	def request(self):
+		self.generation += 1
+		self.timer.restart()
+	
+	# this function listens to the timer, which fires on the event dispatch thread
+	def actionPerformed(self, event):
+		PreviewWorker(self, self.generation).execute()
+
+
+class PreviewWorker(SwingWorker):
+	def __init__(self, renderer, generation):
+		SwingWorker.__init__(self)
+		self.renderer = renderer
+		self.generation = generation
+	
+	def doInBackground(self):
+		return self.renderer.render()
+	
+	# called on the event dispatch thread once the frame is rendered
+	def done(self):
+		if self.generation == self.renderer.generation:
+			self.renderer.publish(self.get())
+
+
+# raised by the progress function of an AnalysisTask (see stack_profiles()) once the task is cancelled
+class AnalysisCancelled(Exception):
+	pass
+
+
+# runs compute(progress) off the event dispatch thread so that Fiji stays responsive, the progress is shown in the
+# ImageJ status bar and the result is handed to finish() on the event dispatch thread once complete
+# button: button that started the task, it reads "Cancel" while the task runs
+# abort: optional function called on the event dispatch thread instead of finish() when the task is cancelled or fails
+class AnalysisTask(SwingWorker):
+	def __init__(self, title, compute, finish, button=None, abort=None):
+		SwingWorker.__init__(self)
+		self.title = title
+		self.compute = compute
+		self.finish = finish
+		self.button = button
+		self.abort = abort
+		if button is not None:
+			self.label = button.getText()
+			button.setText("Cancel")
+		IJ.showStatus(title + "...")
+	
+	def doInBackground(self):
+		return self.compute(self.progress)
+	
+	# called from the worker threads
+	def progress(self, done, total):
+		if self.isCancelled():
+			raise AnalysisCancelled()
+		IJ.showProgress(done, total)
+	
+	def done(self):
+		if self.button is not None:
+			self.button.setText(self.label)
+		IJ.showProgress(1.0)
+		if self.isCancelled():
+			IJ.showStatus(self.title + " cancelled")
+			if self.abort is not None:
+				self.abort()
+			return
+		try:
+			result = self.get()
+		except ExecutionException as error:
+			IJ.showStatus("")
+			if self.abort is not None:
+				self.abort()
+			IJ.showMessage(self.title, "%s failed: %s" % (self.title, error.getCause()))
+			return
+		IJ.showStatus("")
+		self.finish(result)
+
+
 class BackgroundListener(DocumentListener):
 	def __init__(self, textfields, frame, fieldListener):
 		self.textfields = textfields
@@ -142,6 +503,10 @@ class BackgroundListener(DocumentListener):
 		self.lane_sep = fieldListener.lane_sep
 		self.lane_width = fieldListener.lane_width
 		self.lane_count = fieldListener.lane_count
+		self.lane_angle = fieldListener.lane_angle
+		self.lane_bend = fieldListener.lane_bend
+		self.moments_cache = {} # background columns sampled so far, see extract_background()
+		self.task = None # AnalysisTask removing the background
 	
 	def updateFields(self):
 		try:
@@ -154,80 +519,79 @@ class BackgroundListener(DocumentListener):
 		self.bg_sep = bg_sep
 	
 	def backgroundPreview(self):
-		self.fieldListener.lanePreview()
-		
-		ip = self.fieldListener.imp.getProcessor().convertToRGB()
-
-		for i in range(2):
+		lines = []
+		for i in range(2): # TODO implement width setting for background as well?
 			if self.fieldListener.lane_dir == "vertical":
-				roi = Line(self.bg_x + i * self.bg_sep, self.first_y,
-							self.bg_x + i * self.bg_sep, self.first_y + self.lane_length)
+				lines.append((self.bg_x + i * self.bg_sep, self.first_y,
+							self.bg_x + i * self.bg_sep, self.first_y + self.lane_length))
 			else:
-				roi = Line(self.bg_x + i * self.bg_sep, self.first_y - 0.5 * self.lane_width,
+				lines.append((self.bg_x + i * self.bg_sep, self.first_y - 0.5 * self.lane_width,
 							self.bg_x + i * self.bg_sep,
-							self.first_y + (self.lane_count - 1) * self.lane_sep + 0.5 * self.lane_width)
-
-			roi.setStrokeWidth(5) # TODO implement width setting for background as well?
-
-			ip.setRoi(roi)
-			ip.setColor("black")
-			ip.draw(roi)
-			
-		self.fieldListener.imp.setProcessor(ip)
+							self.first_y + (self.lane_count - 1) * self.lane_sep + 0.5 * self.lane_width))
+		
+		self.fieldListener.preview_lines = lines
+		self.fieldListener.lanePreview()
 		
 		self.fieldListener.plot.restorePlotObjects()
 		self.a, self.b, self.c = extract_background(self.bg_x, self.bg_sep, self.first_y, self.lane_length,
 													self.fieldListener.lane_dir, self.lane_count,
 													self.lane_sep, self.lane_width,
 													self.fieldListener.analysis_imp,
-													self.fieldListener.plot)
+													self.fieldListener.plot, self.moments_cache)
 		
+	# removes the background on an AnalysisTask, clicking the button again while it runs cancels it
 	def removeBackground(self, event):
+		if self.task is not None and not self.task.isDone():
+			self.task.cancel(False)
+			return
+		lane_dir = self.fieldListener.lane_dir
 		imp = self.fieldListener.analysis_imp
+		cache = self.fieldListener.result_cache
+		a, b, c = self.a, self.b, self.c
+		@stage("removeBackground")
+		def compute(progress):
+			profiles = lane_profiles(self.first_x, self.first_y, self.lane_length, self.lane_sep, self.lane_width,
+									self.lane_count, lane_dir, imp, self.lane_angle, self.lane_bend, cache, progress)
+			adj_profiles = subtract_background(profiles, a, b, c, self.first_x, self.lane_sep, self.lane_width,
+												lane_dir, self.lane_angle, self.lane_bend)
+			plot = Plot("Gel profiles", "Distance (pixels)", "Gray value")
+			for i in range(self.lane_count):
+				plot.setColor(COLORS[i % len(COLORS)])
+				plot_profile(plot, adj_profiles[i])
+			plot.setColor("black")
+			plot.addLegend("	".join(["Lane " + str(i + 1) for i in range(self.lane_count)]))
+			return profiles, adj_profiles, prefix_sums(adj_profiles), plot
+		self.task = AnalysisTask("Removing background", compute, self.showBackgroundRemoved, self.remove_button,
+								self.fieldListener.dropRecipe)
+		self.task.execute()
+	
+	# called on the event dispatch thread with the result of removeBackground(), dropped when the user went back
+	# to the lane selection meanwhile
+	def showBackgroundRemoved(self, result):
+		if self.panel.getParent() is None: # the frame shows another step
+			return
+		self.profiles, self.adj_profiles, self.adj_prefix_sums, plot = result
 
-		plot = Plot("Gel profiles", "Distance (pixels)", "Gray value")
-		self.adj_profiles = []
-
-		for i in range(self.lane_count):
-			if self.fieldListener.lane_dir == "vertical":
-				x = self.first_x + i * self.lane_sep
-				roi = Line(x, self.first_y, x, self.first_y + self.lane_length)
-			else:
-				y = self.first_y + i * self.lane_sep
-				roi = Line(self.first_x, y, self.first_x + self.lane_length, y)
-				
-			roi.setStrokeWidth(self.lane_width)
-			imp.setRoi(roi)
-			pp = ProfilePlot(imp)
-			values = pp.getProfile()
-			
-			for j in range(self.lane_length):
-				if self.fieldListener.lane_dir == "vertical":
-					y = self.first_y + j
-				else:
-					y = i * self.lane_sep + 0.5 * self.lane_width
-					x = self.first_x + j
-				values[j] = values[j] - (self.a * x + self.b * y + self.c)
-			plot.setColor(COLORS[i % len(COLORS)])
-			plot.add("line", values)
-			self.adj_profiles.append(values)
-
-		self.fieldListener.lanePreview() # removes background lines on gel
+		self.fieldListener.preview_lines = [] # removes background lines on gel
+		self.fieldListener.lanePreview()
 		self.fieldListener.plotWindow.close()
 		self.plotWindow = plot.show()
 		self.adj_plot = plot
-		self.adj_plot.savePlotObjects()
 		
 		measurement_window(self.frame, self)
 
-	# function used for "Back" button
+	# function used for "Back" button, a running background removal is cancelled
 	def revertToPrevStep(self, event):
+		if self.task is not None and not self.task.isDone():
+			self.task.cancel(False)
+		self.fieldListener.dropRecipe()
 		self.frame.getContentPane().removeAll()
 		self.frame.setTitle("Lane selection")
 		self.frame.getContentPane().add(self.fieldListener.panel)
 		self.frame.setLocationRelativeTo(None)
 		self.frame.pack()
 		self.fieldListener.plotWindow.close()
+		self.fieldListener.preview_lines = []
 		self.fieldListener.lanePreview()
 	
 	# following three functions listen to changes in text fields checked by updateFields()
@@ -253,6 +617,7 @@ class MeasurementListener(DocumentListener, ItemListener):
 		self.selectionList = []
 		self.addSelectionArea()
 		self.selected_i = 0
+		self.drawn_bounds = None # peak sum borders shown on the plot and the gel
 		
 		self.first_x = backgroundListener.first_x
 		self.first_y = backgroundListener.first_y
@@ -261,7 +626,9 @@ class MeasurementListener(DocumentListener, ItemListener):
 		self.lane_count = backgroundListener.lane_count
 		self.adj_plot = self.backgroundListener.adj_plot
 		self.adj_profiles = self.backgroundListener.adj_profiles
+		self.adj_prefix_sums = self.backgroundListener.adj_prefix_sums
 		self.fieldListener = backgroundListener.fieldListener
+		self.task = None # AnalysisTask saving the measurement
 	
 	def updateFields(self):
 		try:
@@ -275,71 +642,137 @@ class MeasurementListener(DocumentListener, ItemListener):
 		self.selectionList[self.selected_i][0] = left_bound
 		self.selectionList[self.selected_i][1] = right_bound
 	
-	def sumProfiles(self):	
-		self.adj_plot.restorePlotObjects()
-		self.adj_plot.setColor("black")
-		limits = self.adj_plot.getLimits()
-		min_y = limits[2]
-		max_y = limits[3]
-		legend = "	".join(["Lane " + str(i + 1) for i in range(self.lane_count)])
-		self.adj_plot.addLegend(legend)
-		self.adj_plot.drawLine(self.left_bound, min_y, self.left_bound, max_y)
-		self.adj_plot.drawLine(self.right_bound, min_y, self.right_bound, max_y)
-		self.adj_plot.update()
+	# the sums and borders are only updated when the borders change, e.g. not for both document events of a
+	# text field or for a newly selected area with the same borders
+	@stage("sumProfiles")
+	def sumProfiles(self):
+		if self.drawn_bounds == (self.left_bound, self.right_bound):
+			return
+		self.drawn_bounds = (self.left_bound, self.right_bound)
+		self.drawBorders()
 		
 		for i in range(self.lane_count):
-			lane_sum = sum(self.adj_profiles[i][self.left_bound:self.right_bound])
+			lane_sum = peak_sum(self.adj_prefix_sums[i], self.left_bound, self.right_bound)
 			self.result_fields[i].setText(str(round(lane_sum, 3)))
 			
 		# display left and right borders on gel
-		self.fieldListener.lanePreview()
-		
-		ip = self.fieldListener.imp.getProcessor().convertToRGB()
-		
 		if self.fieldListener.lane_dir == "vertical":
 			line_ys = [self.first_y + self.left_bound, self.first_y + self.right_bound]
 		else:
 			line_xs = [self.first_x + self.left_bound, self.first_x + self.right_bound]
 
+		lines = []
 		for i in range(2):
 			if self.fieldListener.lane_dir == "vertical":
-				roi = Line(self.first_x - 0.5 * self.lane_width,
+				lines.append((self.first_x - 0.5 * self.lane_width,
 							line_ys[i],
 							self.first_x + (self.lane_count - 1) * self.lane_sep + 0.5 * self.lane_width,
-							line_ys[i])
+							line_ys[i]))
 			else:
-				roi = Line(line_xs[i],
+				lines.append((line_xs[i],
 							self.first_y - 0.5 * self.lane_width,
 							line_xs[i],
-							self.first_y + (self.lane_count - 1) * self.lane_sep + 0.5 * self.lane_width)
-			
-			roi.setStrokeWidth(5)
-			ip.setRoi(roi)
-			ip.setColor("black")
-			ip.draw(roi)
-			
-		self.fieldListener.imp.setProcessor(ip)
+							self.first_y + (self.lane_count - 1) * self.lane_sep + 0.5 * self.lane_width))
+		
+		self.fieldListener.preview_lines = lines
+		self.fieldListener.lanePreview()
+	
+	# the borders are drawn as an overlay of the plot image, so the profiles are not plotted again
+	def drawBorders(self):
+		frame = self.adj_plot.getDrawingFrame()
+		overlay = Overlay()
+		for bound in (self.left_bound, self.right_bound):
+			x = self.adj_plot.scaleXtoPxl(bound)
+			line = Line(x, frame.y, x, frame.y + frame.height)
+			line.setStrokeColor(Color.black)
+			overlay.add(line)
+		self.adj_plot.getImagePlus().setOverlay(overlay)
 
+	# the peak sums are saved together with the recipe of the gel, which is kept next to the gel file
+	# (or next to the results for images that were not opened from a file), and appended to the result store
+	# of the results folder, all slices of a stack are measured with the lanes, background lines and selection
+	# areas set on the displayed slice
+	# saving runs on an AnalysisTask, clicking the button again while it runs cancels it (before anything is written)
+	# while stage timings are recorded, they are shown in the ImageJ Log and saved next to the results
+	# (results.txt -> results.stages.json)
 	def saveMeasurement(self, event):
+		if self.task is not None and not self.task.isDone():
+			self.task.cancel(False)
+			return
 		save_dialog = SaveDialog("Save peak sums", "results", ".txt")
 		directory = save_dialog.getDirectory()
 		if directory != None:
 			filename = save_dialog.getFileName()
-			f = open(directory + "/" + filename, "w")
-			results = str("\t".join(["Lane no."] + ["Selection " + str(i + 1) for i in range(len(self.selectionList))])) + "\n"
-			for i in range(self.lane_count):
-				lane_line = ["Lane " + str(i + 1)]
-				for j in range(len(self.selectionList)):
-					left_bound = self.selectionList[j][0]
-					right_bound = self.selectionList[j][1]
-					lane_sum = round(sum(self.backgroundListener.adj_profiles[i][left_bound:right_bound]), 3)
-					lane_line.append(str(lane_sum))
-				results += "\t".join(lane_line) + "\n"
-			f.write(results)
-			f.close()
+			params = self.recipeParameters()
+			self.task = AnalysisTask("Saving measurement",
+									lambda progress: self.writeMeasurement(directory, filename, params, progress),
+									self.showSaved, self.save_button)
+			self.task.execute()
 	
-	# function used for "Back" button
+	# called on the event dispatch thread with the path of the results saved by writeMeasurement()
+	def showSaved(self, path):
+		if STAGE_STATS.enabled:
+			IJ.log(STAGE_STATS.report())
+			path = os.path.splitext(path)[0] + ".stages.json"
+			STAGE_STATS.save(path)
+			IJ.log("Stage timings saved to " + path)
+	
+	# the part of saveMeasurement() after the file dialog, run off the event dispatch thread and timed as its stage
+	# params: recipeParameters() of the measurement, progress: see stack_profiles()
+	@stage("saveMeasurement")
+	def writeMeasurement(self, directory, filename, params, progress):
+		source_imp = self.fieldListener.source_imp
+		if source_imp.getStackSize() > 1:
+			imps, labels = stack_images(source_imp, self.fieldListener.native)
+			results = measure_stack(imps, cache=self.fieldListener.result_cache, progress=progress, **params)
+			text = format_stack_results([result["sums"] for result in results], labels)
+		else:
+			bl = self.backgroundListener
+			imps, labels = [self.fieldListener.analysis_imp], [None]
+			results = [{"profiles": bl.profiles, "plane": (bl.a, bl.b, bl.c),
+						"sums": measure_selections(self.adj_prefix_sums, params["selections"])}]
+			text = format_results(results[0]["sums"])
+		f = open(directory + "/" + filename, "w")
+		f.write(text)
+		f.close()
+		
+		gel_path = self.fieldListener.gelPath() or os.path.join(directory, filename)
+		path = recipe_path(gel_path)
+		save_recipe(path, params, self.fieldListener.native, self.fieldListener.contrast_enhanced)
+		IJ.log("Recipe saved to " + path)
+		
+		path = os.path.join(directory, RESULT_STORE_NAME)
+		analysed = time.time()
+		records = []
+		for k in range(len(imps)):
+			raw_sums = measure_selections(prefix_sums(results[k]["profiles"]), params["selections"])
+			records.append(store_record(gel_path, imps[k], params, self.fieldListener.native, "profile",
+										results[k]["plane"], params["selections"], raw_sums, results[k]["sums"],
+										k + 1, labels[k], analysed))
+		try:
+			store = ResultStore(path)
+			try:
+				store.addGels(records)
+			finally:
+				store.close()
+			IJ.log("Results added to " + path)
+		except Exception as error: # e.g. no SQLite JDBC driver, the .txt file is saved anyway
+			IJ.log("Results not added to %s: %s" % (path, error))
+		return os.path.join(directory, filename)
+	
+	# complete parameter set of the current analysis, see save_recipe()
+	def recipeParameters(self):
+		params = dict((name, getattr(self.fieldListener, name)) for name, title in GEOMETRY_FIELDS)
+		params.update({"lane_direction": self.fieldListener.lane_dir, "lane_angle": self.fieldListener.lane_angle,
+					"lane_bend": self.fieldListener.lane_bend, "bg_x": self.backgroundListener.bg_x,
+					"bg_sep": self.backgroundListener.bg_sep,
+					"selections": [list(area) for area in self.selectionList]})
+		return params
+	
+	# function used for "Back" button, a running save is cancelled
 	def revertToPrevStep(self, event):
+		if self.task is not None and not self.task.isDone():
+			self.task.cancel(False)
 		self.frame.getContentPane().removeAll()
 		self.frame.setTitle("Lane selection")
 		self.frame.getContentPane().add(self.backgroundListener.panel)
@@ -354,6 +787,23 @@ class MeasurementListener(DocumentListener, ItemListener):
 	def addSelectionArea(self):
 		self.selectionList.append([self.min_bound, self.max_bound])
 	
+	# function listens to "Detect bands" button, replaces the selection areas by one area per band
+	def detectBandsEvent(self, event):
+		areas = detect_bands(self.adj_profiles)
+		if not areas:
+			IJ.showMessage("Band detection", "No bands were found, please set the peak sum borders by hand.")
+			return
+		self.setSelectionAreas(areas)
+	
+	# replaces the selection areas, e.g. by detected bands or by the areas of a recipe
+	def setSelectionAreas(self, areas):
+		self.selectionList = [list(area) for area in areas]
+		self.selected_i = 0
+		# adding the first item selects it, which fills the border fields through itemStateChanged()
+		self.area_selector.removeAllItems()
+		for i in range(len(areas)):
+			self.area_selector.addItem("Selection area " + str(i + 1))
+	
 	# function listens to "add selection area" button
 	def addSelectionAreaEvent(self, event):
 		self.area_selector.addItem("Selection area " + str(self.area_selector.getItemCount() + 1))
@@ -383,86 +833,1164 @@ class MeasurementListener(DocumentListener, ItemListener):
 
 # Parameters:
 # lane_direction: "vertical" / "horizontal"
-def analyze(first_x, first_y, lane_length, lane_sep, lane_width, lane_count, lane_direction, imp):
+# progress: see stack_profiles()
+@stage("analyze")
+def analyze(first_x, first_y, lane_length, lane_sep, lane_width, lane_count, lane_direction, imp, lane_angle=0.0,
+			lane_bend=None, cache=None, progress=None):
 	plot = Plot("Gel profiles", "Distance (pixels)", "Gray value")
-	plvalues = []
+	plvalues = lane_profiles(first_x, first_y, lane_length, lane_sep, lane_width, lane_count, lane_direction, imp,
+							lane_angle, lane_bend, cache, progress)
 
+	for i in range(lane_count):
+		plot.setColor(COLORS[i % len(COLORS)])
+		plot_profile(plot, plvalues[i])
+
+	return plot, plvalues
+
+# adds a profile to a plot decimated to the width of plot windows, the full profile is kept for the analysis
+def plot_profile(plot, values):
+	xs, ys = decimate_profile(values, PlotWindow.plotWidth)
+	plot.add("line", xs, ys)
+
+# min/max decimation of a profile for display: for each of the buckets of consecutive values only the lowest and
+# the highest value are kept in their order, so peaks and dips stay visible at any zoom of the plot window,
+# returns the x values (indices) and values of the kept points, short profiles are kept whole
+def decimate_profile(values, buckets):
+	n = len(values)
+	if n <= 2*buckets:
+		return [float(x) for x in range(n)], list(values)
+	xs = []
+	ys = []
+	for k in range(buckets):
+		start = k*n // buckets
+		chunk = values[start:(k + 1)*n // buckets]
+		for i in sorted(set([chunk.index(min(chunk)), chunk.index(max(chunk))])):
+			xs.append(float(start + i))
+			ys.append(chunk[i])
+	return xs, ys
+
+# Parameters:
+# lane_direction: "vertical" / "horizontal"
+# returns the center line (x1, y1, x2, y2) of every lane
+def lane_lines(first_x, first_y, lane_length, lane_sep, lane_count, lane_direction):
+	lines = []
 	for i in range(lane_count):
 		if lane_direction == "vertical":
-			roi = Line(first_x + i*lane_sep, first_y, first_x + i*lane_sep, first_y + lane_length)
+			lines.append((first_x + i*lane_sep, first_y, first_x + i*lane_sep, first_y + lane_length))
 		else:
-			roi = Line(first_x, first_y + i*lane_sep, first_x + lane_length, first_y + i*lane_sep)
+			lines.append((first_x, first_y + i*lane_sep, first_x + lane_length, first_y + i*lane_sep))
+	return lines
 
-		roi.setStrokeWidth(lane_width)
-		imp.setRoi(roi)
-		pp = ProfilePlot(imp)
-		plvalues.append(pp.getProfile())
+# Parameters:
+# lane_direction: "vertical" / "horizontal"
+# lane_angle, lane_bend: see lane_offset(), tilted or bent lanes are sampled through a LaneGrid
+# cache: optional ResultCache, profiles found there are not sampled again
+# lanes are sampled in parallel on LANE_THREADS threads
+def lane_profiles(first_x, first_y, lane_length, lane_sep, lane_width, lane_count, lane_direction, imp, lane_angle=0.0,
+				lane_bend=None, cache=None, progress=None):
+	return stack_profiles(first_x, first_y, lane_length, lane_sep, lane_width, lane_count, lane_direction, [imp],
+						lane_angle, lane_bend, cache, progress)[0]
 
-		plot.setColor(COLORS[i % len(COLORS)])
-		plot.add("line", plvalues[i])
+# lane_profiles() of every slice of a stack (see load_stack()), one list of profiles per slice
+# straight lanes are sampled lane by lane, each lane task reading the lane region of all slices at once, tilted
+# and bent lanes share one LaneGrid between the slices
+# progress: optional function called with (done, total) after every sampled lane (of every slice for tilted lanes)
+#           and before hashing an image, it may raise AnalysisCancelled to stop the sampling
+@stage("stack_profiles")
+def stack_profiles(first_x, first_y, lane_length, lane_sep, lane_width, lane_count, lane_direction, imps,
+				lane_angle=0.0, lane_bend=None, cache=None, progress=None):
+	if progress is None:
+		progress = lambda done, total: None
+	profiles = [None] * len(imps)
+	keys = [None] * len(imps)
+	if cache is not None:
+		for k in range(len(imps)):
+			progress(k, len(imps)) # hashing may read the whole image, a cancelled task stops before
+			keys[k] = ["profiles", image_hash(imps[k]), first_x, first_y, lane_length, lane_sep, lane_width, lane_count,
+						lane_direction, lane_angle or 0.0, list(lane_bend or [])]
+			profiles[k] = cache.get(keys[k])
+	missing = [k for k in range(len(imps)) if profiles[k] is None]
+	if not missing:
+		return profiles
+	
+	finished = count(1) # approximate across threads, only used for the progress
+	if not is_straight(lane_angle, lane_bend):
+		total = len(missing) * lane_count
+		lane_done = lambda: progress(next(finished), total)
+		sampled = []
+		for m, k in enumerate(missing):
+			progress(m * lane_count, total)
+			sampled.append(grid_profiles(first_x, first_y, lane_length, lane_sep, lane_width, lane_count,
+										lane_direction, imps[k], lane_angle, lane_bend, lane_done))
+	else:
+		lines = lane_lines(first_x, first_y, lane_length, lane_sep, lane_count, lane_direction)
+		def sample(line):
+			lane = [sample_line(imps[k], line[0], line[1], line[2], line[3], lane_width) for k in missing]
+			progress(next(finished), len(lines))
+			return lane
+		by_lane = thread_map(sample, lines, LANE_THREADS)
+		sampled = [[lane[m] for lane in by_lane] for m in range(len(missing))]
+	for k, slice_profiles in zip(missing, sampled):
+		profiles[k] = slice_profiles
+		if cache is not None:
+			cache.put(keys[k], slice_profiles)
+	return profiles
 
-	return plot, plvalues
+def is_straight(lane_angle, lane_bend):
+	return not lane_angle and not any(lane_bend or [])
+
+# Parameters:
+# lane_direction: "vertical" / "horizontal"
+# lane_angle: rotation of the lanes in degrees about the start of the first lane, clockwise on the screen
+# returns the unit vectors (x, y) along the lanes and across them, towards the next lane
+def lane_axes(lane_direction, lane_angle=0.0):
+	angle = math.radians(lane_angle or 0.0)
+	cos = math.cos(angle)
+	sin = math.sin(angle)
+	if lane_direction == "vertical":
+		return (-sin, cos), (cos, sin)
+	return (cos, sin), (-sin, cos)
+
+# sideways shift of the lane centerline at distance t along a lane, lane_bend holds the shifts in pixels at evenly
+# spaced points from the start to the end of the lanes (e.g. [0, 4, 0] for lanes bowed towards the next lane),
+# linearly interpolated in between
+def bend_offset(lane_bend, lane_length, t):
+	if not lane_bend:
+		return 0.0
+	if len(lane_bend) == 1 or lane_length <= 0:
+		return float(lane_bend[0])
+	position = min(max(t / float(lane_length), 0.0), 1.0) * (len(lane_bend) - 1)
+	k = min(int(position), len(lane_bend) - 2)
+	fraction = position - k
+	return lane_bend[k] * (1.0 - fraction) + lane_bend[k + 1] * fraction
+
+# whole pixel offset (dx, dy) of the start of lane i from the start of the first lane, tilted lanes are rounded
+# to whole pixels so that all lanes share one LaneGrid
+def lane_start_offset(i, lane_sep, lane_direction, lane_angle=0.0):
+	along, across = lane_axes(lane_direction, lane_angle)
+	return int(math.floor(i*lane_sep*across[0] + 0.5)), int(math.floor(i*lane_sep*across[1] + 0.5))
+
+# Parameters:
+# lane_direction: "vertical" / "horizontal"
+# lane_angle, lane_bend: see lane_axes() and bend_offset()
+# returns the offset (dx, dy) from the start of the first lane of the centerline of lane i at distance t along it
+def lane_offset(i, t, lane_length, lane_sep, lane_direction, lane_angle=0.0, lane_bend=None):
+	(ux, uy), (vx, vy) = lane_axes(lane_direction, lane_angle)
+	start_x, start_y = lane_start_offset(i, lane_sep, lane_direction, lane_angle)
+	shift = bend_offset(lane_bend, lane_length, t)
+	return start_x + t*ux + shift*vx, start_y + t*uy + shift*vy
 
 # Parameters:
 # lane_direction: "vertical" / "horizontal"
-def extract_background(bg_x, bg_sep, first_y, lane_length, lane_direction, lane_count, lane_sep, lane_width, imp, plot=None):
-	plvalues = {}
+# returns the x and y coordinates of the outline of lane i, a rectangle for straight lanes
+def lane_outline(i, first_x, first_y, lane_length, lane_sep, lane_width, lane_direction, lane_angle=0.0,
+				lane_bend=None):
+	vx, vy = lane_axes(lane_direction, lane_angle)[1]
+	steps = max(1, len(lane_bend or []) - 1)
+	centers = [lane_offset(i, k * lane_length / float(steps), lane_length, lane_sep, lane_direction, lane_angle, lane_bend)
+				for k in range(steps + 1)]
+	half = 0.5 * lane_width
+	side = [(first_x + dx - half*vx, first_y + dy - half*vy) for dx, dy in centers]
+	side += [(first_x + dx + half*vx, first_y + dy + half*vy) for dx, dy in reversed(centers)]
+	return [x for x, y in side], [y for x, y in side]
+
+# "0, 4, 0" typed in the lane selection window or on the command line, see bend_offset()
+def parse_bend(text):
+	return [float(value) for value in text.replace(",", " ").split()]
+
+# bilinear interpolation weights of one lane shape: for every profile point (one per pixel along the lane) the pixels
+# around all the points across the lane width, merged and relative to the lane start, a profile value is then
+# the weighted sum of these pixels; lanes of a gel only differ in their start pixel, so one grid samples all of them
+# a lane is sampled from the window of the pixels around it (see window()), the pixels of all points are picked
+# from it at once
+class LaneGrid(object):
+	def __init__(self, lane_length, lane_width, lane_direction, lane_angle=0.0, lane_bend=None):
+		(ux, uy), (vx, vy) = lane_axes(lane_direction, lane_angle)
+		width = lane_width or 1
+		points = [] # (pixels (dx, dy), weights) of every profile point
+		for j in range(lane_length + 1):
+			shift = bend_offset(lane_bend, lane_length, j)
+			weights = {}
+			for k in range(width):
+				across = shift + k - 0.5*(width - 1)
+				x = j*ux + across*vx
+				y = j*uy + across*vy
+				x0 = int(math.floor(x))
+				y0 = int(math.floor(y))
+				fx = x - x0
+				fy = y - y0
+				for pixel, weight in [((x0, y0), (1 - fx) * (1 - fy)), ((x0 + 1, y0), fx * (1 - fy)),
+									((x0, y0 + 1), (1 - fx) * fy), ((x0 + 1, y0 + 1), fx * fy)]:
+					if weight > 1e-12:
+						weights[pixel] = weights.get(pixel, 0.0) + weight / width
+			pixels = sorted(weights)
+			points.append((pixels, [weights[pixel] for pixel in pixels]))
+		self.min_dx = min(dx for pixels, weights in points for dx, dy in pixels)
+		self.max_dx = max(dx for pixels, weights in points for dx, dy in pixels)
+		self.min_dy = min(dy for pixels, weights in points for dx, dy in pixels)
+		self.max_dy = max(dy for pixels, weights in points for dx, dy in pixels)
+		
+		# flat row by row indices of the pixels of all points in the window of a lane, and the range of the pixels
+		# of every point with their weights
+		window_width = self.max_dx - self.min_dx + 1
+		indices = []
+		self.points = []
+		for pixels, weights in points:
+			self.points.append((len(indices), len(indices) + len(pixels), weights))
+			indices.extend([(dy - self.min_dy)*window_width + dx - self.min_dx for dx, dy in pixels])
+		if len(indices) > 1:
+			self.values = operator.itemgetter(*indices)
+		else: # itemgetter of one index returns the value itself
+			self.values = lambda window: (window[indices[0]],)
+	
+	# window (x0, y0, x1, y1) of the pixels sampled for the lane starting at pixel (x, y), see pixel_window()
+	def window(self, x, y):
+		return x + self.min_dx, y + self.min_dy, x + self.max_dx + 1, y + self.max_dy + 1
+	
+	# profile of a lane from the pixel_window() of its window()
+	def sample(self, window):
+		values = self.values(window)
+		return [sum(map(operator.mul, values[start:stop], weights)) for start, stop, weights in self.points]
+
+def lane_grid(lane_length, lane_width, lane_direction, lane_angle, lane_bend):
+	key = (lane_length, lane_width, lane_direction, float(lane_angle or 0.0), tuple(lane_bend or []))
+	grid = GRID_CACHE.get(key)
+	if grid is None:
+		grid = LaneGrid(lane_length, lane_width, lane_direction, lane_angle, lane_bend)
+		GRID_CACHE.put(key, grid)
+	return grid, key
+
+# flat row by row values of the pixels x0 <= x < x1, y0 <= y < y1 of an image, pixels outside the image are 0, the
+# inversion of an InvertedImage is left to the caller
+# only the window is read: a region of a MappedImage or a crop of the processor of an ImagePlus
+def pixel_window(imp, x0, y0, x1, y1):
+	cx0, cy0 = min(max(0, x0), x1), min(max(0, y0), y1)
+	cx1, cy1 = max(cx0, min(imp.getWidth(), x1)), max(cy0, min(imp.getHeight(), y1))
+	pixels, stride, start = [], 0, 0 # nothing to read outside the image
+	if isinstance(imp, PixelImage):
+		pixels, stride, start = imp.pixels, imp.width, cy0*imp.width + cx0
+	elif cx1 > cx0 and cy1 > cy0:
+		if isinstance(imp, MappedImage):
+			pixels = imp.region(cx0, cy0, cx1, cy1).pixels
+		else:
+			view = pixel_view(imp.getProcessor())
+			view.setRoi(cx0, cy0, cx1 - cx0, cy1 - cy0)
+			pixels = view.crop().convertToFloat().getPixels()
+		if (cx0, cy0, cx1, cy1) == (x0, y0, x1, y1):
+			return pixels
+		stride, start = cx1 - cx0, 0
+	width = x1 - x0
+	left = [0.0] * (cx0 - x0)
+	right = [0.0] * (x1 - cx1)
+	window = [0.0] * ((cy0 - y0) * width)
+	for y in range(cy1 - cy0):
+		row = start + y*stride
+		window.extend(left)
+		window.extend(pixels[row:row + cx1 - cx0])
+		window.extend(right)
+	window.extend([0.0] * ((y1 - cy1) * width))
+	return window
+
+# lane_profiles() of tilted or bent lanes, every lane is sampled with the same LaneGrid from the window of pixels
+# around it
+# lane_done: optional function called after every sampled lane, see the progress of stack_profiles()
+def grid_profiles(first_x, first_y, lane_length, lane_sep, lane_width, lane_count, lane_direction, imp, lane_angle,
+				lane_bend, lane_done=None):
+	if lane_done is None:
+		lane_done = lambda: None
+	source = imp.image if isinstance(imp, InvertedImage) else imp
+	grid, grid_key = lane_grid(lane_length, lane_width, lane_direction, lane_angle, lane_bend)
 	
+	starts = []
+	for i in range(lane_count):
+		dx, dy = lane_start_offset(i, lane_sep, lane_direction, lane_angle)
+		starts.append((int(math.floor(first_x + 0.5)) + dx, int(math.floor(first_y + 0.5)) + dy))
+	keys = [(imp.getID(), x, y, grid_key) for x, y in starts]
+	profiles = [PROFILE_CACHE.get(key) for key in keys]
+	missing = [i for i in range(lane_count) if profiles[i] is None]
+	def sample(i):
+		x0, y0, x1, y1 = grid.window(starts[i][0], starts[i][1])
+		profile = grid.sample(pixel_window(source, x0, y0, x1, y1))
+		if source is not imp:
+			profile = [imp.max_value - value for value in profile]
+		PROFILE_CACHE.put(keys[i], profile)
+		lane_done()
+		return profile
+	for i, profile in zip(missing, thread_map(sample, missing, LANE_THREADS)):
+		profiles[i] = profile
+	return profiles
+
+# Parameters:
+# lane_direction: "vertical" / "horizontal"
+# returns a dict with for each absolute x of a background sample column its line (x1, y1, x2, y2)
+def background_lines(bg_x, bg_sep, first_y, lane_length, lane_direction, lane_count, lane_sep, lane_width):
+	lines = {}
 	for i in range(2):
 		for x_offset in range(-2, 3): # get multiple lines instead of average over five pixels
+			x = bg_x + i*bg_sep + x_offset
 			if lane_direction == "vertical":
-				roi = Line(bg_x + i*bg_sep + x_offset, first_y,
-							bg_x + i*bg_sep + x_offset, first_y + lane_length)
+				lines[x] = (x, first_y, x, first_y + lane_length)
 			else:
 				y_offset = 0.5*lane_width
-				roi = Line(bg_x + i*bg_sep + x_offset, first_y - y_offset,
-							bg_x + i*bg_sep + x_offset, first_y + (lane_count - 1)*lane_sep + y_offset)
-			
-			imp.setRoi(roi)
-			pp = ProfilePlot(imp)
-			plvalues[bg_x + i*bg_sep + x_offset] = pp.getProfile()
+				lines[x] = (x, first_y - y_offset, x, first_y + (lane_count - 1)*lane_sep + y_offset)
+	return lines
+
+# Parameters:
+# lane_direction: "vertical" / "horizontal"
+# moments_cache: optional dict kept between calls, for each absolute x the sampled line and its column_moments(),
+#                only columns whose line changed since the previous call are sampled again
+@stage("extract_background")
+def extract_background(bg_x, bg_sep, first_y, lane_length, lane_direction, lane_count, lane_sep, lane_width, imp, plot=None,
+						moments_cache=None):
+	if moments_cache is None:
+		moments_cache = {}
+	lines = background_lines(bg_x, bg_sep, first_y, lane_length, lane_direction, lane_count, lane_sep, lane_width)
+	for x in list(moments_cache.keys()):
+		if lines.get(x) != moments_cache[x][0]:
+			del moments_cache[x]
+	for x, (x1, y1, x2, y2) in lines.items():
+		if x not in moments_cache:
+			moments_cache[x] = (lines[x], column_moments(x, sample_line(imp, x1, y1, x2, y2)))
 	
-	a, b, c = fit_plane(plvalues)
+	a, b, c = fit_moments([moments for line, moments in moments_cache.values()])
 
 	if plot:
 		for i in range(2):
 			plot.setColor("black")
+			# the estimate is linear along the lines, so only their end points are plotted
+			ends = [0.0, float(lane_length - 1)]
 			if lane_direction == "vertical": # lines on graph represent background estimate at the background lines on gel
 				x = bg_x + i*bg_sep
-				bg_values = [x*a + y*b + c for y in range(lane_length)]
+				bg_values = [x*a + y*b + c for y in ends]
 			else: # lines on graph represent background estimate at the highest and lowest lane
 				y = i*(lane_count - 1)*lane_sep + 0.5*lane_width
-				bg_values = [(x + bg_x)*a + y*b + c for x in range(lane_length)]
-			plot.add("line", bg_values)
+				bg_values = [(x + bg_x)*a + y*b + c for x in ends]
+			plot.add("line", ends, bg_values)
 	
 	return a, b, c
 
+# Parameters:
+# lane_direction: "vertical" / "horizontal"
+# returns the lane profiles with the fitted background plane a*x + b*y + c subtracted, input profiles are not modified
+# y is relative to the top of the background lines as in extract_background(), i.e. to first_y for vertical lanes
+# along a straight lane the plane is an arithmetic progression, so one ramp is built and subtracted from every lane
+# in bulk, for tilted or bent lanes the plane is evaluated along each centerline
+@stage("subtract_background")
+def subtract_background(profiles, a, b, c, first_x, lane_sep, lane_width, lane_direction, lane_angle=0.0,
+						lane_bend=None):
+	if not profiles:
+		return []
+	if not is_straight(lane_angle, lane_bend):
+		# the plane along the lane centerline, the first lane starts at y = 0 (vertical) or half a lane width
+		# below the top of the background lines (horizontal)
+		start_y = 0.0 if lane_direction == "vertical" else 0.5*lane_width
+		adj_profiles = []
+		for i in range(len(profiles)):
+			offsets = [lane_offset(i, j, len(profiles[i]) - 1, lane_sep, lane_direction, lane_angle, lane_bend)
+						for j in range(len(profiles[i]))]
+			adj_profiles.append([value - (a*(first_x + dx) + b*(start_y + dy) + c)
+								for value, (dx, dy) in zip(profiles[i], offsets)])
+		return adj_profiles
+	step = b if lane_direction == "vertical" else a
+	ramp = [step*j for j in range(max(len(profile) for profile in profiles))]
+	
+	adj_profiles = []
+	for i in range(len(profiles)):
+		if lane_direction == "vertical":
+			start = a*(first_x + i*lane_sep) + c
+		else:
+			start = a*first_x + b*(i*lane_sep + 0.5*lane_width) + c
+		adj_profiles.append([value - start - offset for value, offset in zip(profiles[i], ramp)])
+	return adj_profiles
+
+# cumulative sums of every profile with a leading zero, built once so that any peak sum is a difference of two values
+def prefix_sums(profiles):
+	prefixes = []
+	for profile in profiles:
+		total = 0.0
+		prefix = [total]
+		for value in profile:
+			total += value
+			prefix.append(total)
+		prefixes.append(prefix)
+	return prefixes
+
+# sum of a background-subtracted profile between the left and right peak sum borders,
+# the borders behave like the slice profile[left_bound:right_bound]
+def peak_sum(prefix, left_bound, right_bound):
+	start, stop, step = slice(left_bound, right_bound).indices(len(prefix) - 1)
+	if stop <= start:
+		return 0.0
+	return prefix[stop] - prefix[start]
+
+# prefixes: prefix_sums() of the background-subtracted profiles
+# selections: list of [left_bound, right_bound] pairs
+# returns for each lane a list of peak sums, one per selection area
+def measure_selections(prefixes, selections):
+	return [[peak_sum(prefix, left, right) for left, right in selections] for prefix in prefixes]
+
+# Parameters:
+# lane_direction: "vertical" / "horizontal"
+# returns the y of the background lines' top, the origin of y in the fitted plane a*x + b*y + c
+def plane_origin(first_y, lane_width, lane_direction):
+	if lane_direction == "vertical":
+		return first_y
+	return first_y - 0.5*lane_width
+
+# integral image of a gel, every rectangle is summed from four table values whatever its size
+# plane: background (a, b, c) from extract_background(), subtracted from every sum analytically, so no corrected
+#        image is ever built
+# y_origin: y where the plane has y = 0, see plane_origin()
+class SummedAreaTable(object):
+	def __init__(self, imp, plane=(0.0, 0.0, 0.0), y_origin=0):
+		self.width = imp.getWidth()
+		self.height = imp.getHeight()
+		self.plane = plane
+		self.y_origin = y_origin
+		
+		# (width + 1) x (height + 1) values row by row, the first row and column are zero
+		stride = self.width + 1
+		self.table = array("d", [0.0] * stride)
+		above = [0.0] * stride
+		for y in range(self.height):
+			total = 0.0
+			row = [total]
+			for value in line_profile(imp, 0, y, self.width - 1, y):
+				total += value
+				row.append(total)
+			above = list(map(operator.add, above, row))
+			self.table.extend(above)
+	
+	# sum of the pixels x0 <= x < x1, y0 <= y < y1 minus the plane, the rectangle is clipped to the image
+	def regionSum(self, x0, y0, x1, y1):
+		x0, x1 = [max(0, min(self.width, int(x))) for x in (x0, x1)]
+		y0, y1 = [max(0, min(self.height, int(y))) for y in (y0, y1)]
+		if x1 <= x0 or y1 <= y0:
+			return 0.0
+		table = self.table
+		stride = self.width + 1
+		total = table[y1*stride + x1] - table[y0*stride + x1] - table[y1*stride + x0] + table[y0*stride + x0]
+		return total - self.planeSum(x0, y0, x1, y1)
+	
+	# sum of a*x + b*(y - y_origin) + c over the rectangle, which is clipped to the image
+	def planeSum(self, x0, y0, x1, y1):
+		x0, x1 = [max(0, min(self.width, int(x))) for x in (x0, x1)]
+		y0, y1 = [max(0, min(self.height, int(y))) for y in (y0, y1)]
+		if x1 <= x0 or y1 <= y0:
+			return 0.0
+		a, b, c = self.plane
+		columns = x1 - x0
+		rows = y1 - y0
+		mean_x = 0.5 * (x0 + x1 - 1)
+		mean_y = 0.5 * (y0 + y1 - 1) - self.y_origin
+		return columns*rows*(a*mean_x + b*mean_y + c)
+
+# Parameters:
+# lane_direction: "vertical" / "horizontal"
+# selections: list of [left_bound, right_bound] pairs
+# returns for each lane the rectangle (x0, y0, x1, y1) of every selection area, covering the same pixels as
+# the profile sampled by lane_profiles()
+def lane_boxes(first_x, first_y, lane_sep, lane_width, lane_count, lane_direction, selections):
+	boxes = []
+	for x1, y1, x2, y2 in lane_lines(first_x, first_y, 0, lane_sep, lane_count, lane_direction):
+		lane = []
+		for left, right in selections:
+			if lane_direction == "vertical":
+				start = int(math.floor(x1 - 0.5*(lane_width - 1) + 0.5))
+				lane.append((start, first_y + left, start + lane_width, first_y + right))
+			else:
+				start = int(math.floor(y1 - 0.5*(lane_width - 1) + 0.5))
+				lane.append((first_x + left, start, first_x + right, start + lane_width))
+		boxes.append(lane)
+	return boxes
+
+# total background-subtracted intensity in every box of lane_boxes(), one list of sums per lane,
+# a box sum is the peak sum of the same area multiplied by the lane width
+# raw: sums without subtracting the background plane
+def measure_boxes(table, boxes, raw=False):
+	if raw:
+		return [[table.regionSum(*box) + table.planeSum(*box) for box in lane] for lane in boxes]
+	return [[table.regionSum(*box) for box in lane] for lane in boxes]
+
+# tab-separated results table, one row per lane and one column per selection area
+# selections: when given, the borders of every area are added to its column title
+def format_results(sums, selections=None):
+	results = "\t".join(["Lane no."] + result_titles(sums, selections)) + "\n"
+	for i in range(len(sums)):
+		lane_line = ["Lane " + str(i + 1)] + [str(round(lane_sum, 3)) for lane_sum in sums[i]]
+		results += "\t".join(lane_line) + "\n"
+	return results
+
+# format_results() of a stack, one row per slice and lane
+# slice_sums: sums of every slice, labels: label of every slice (see load_stack())
+def format_stack_results(slice_sums, labels, selections=None):
+	results = "\t".join(["Slice", "Lane no."] + result_titles(slice_sums[0], selections)) + "\n"
+	for label, sums in zip(labels, slice_sums):
+		for i in range(len(sums)):
+			lane_line = [label, "Lane " + str(i + 1)] + [str(round(lane_sum, 3)) for lane_sum in sums[i]]
+			results += "\t".join(lane_line) + "\n"
+	return results
+
+def result_titles(sums, selections=None):
+	area_count = len(sums[0]) if sums else 0
+	titles = ["Selection " + str(j + 1) for j in range(area_count)]
+	if selections is not None:
+		titles = ["%s (%d:%d)" % (title, left, right) for title, (left, right) in zip(titles, selections)]
+	return titles
+
+# Parameters:
+# lane_direction: "vertical" / "horizontal"
+# returns the background line placement the background window starts with
+def default_background(first_x, lane_length, lane_sep, lane_count, lane_direction):
+	bg_x = int(first_x - 0.5 * lane_sep)
+	if lane_direction == "vertical":
+		return bg_x, lane_count * lane_sep
+	return bg_x, lane_length + lane_sep
+
+# headless version of the whole workflow, runs without any window
+# Parameters:
+# imp: inverted analysis image, see load_image()
+# lane_direction: "vertical" / "horizontal"
+# selections: list of [left_bound, right_bound] pairs
+# cache: optional ResultCache keeping the profiles, the plane and the adjusted profiles of the gel, so measuring
+#        new selection areas of an analysed gel samples nothing
+# profiles: lane profiles of the gel already sampled, e.g. by stack_profiles()
+@stage("measure_gel")
+def measure_gel(imp, first_x, first_y, lane_length, lane_sep, lane_width, lane_count, lane_direction,
+				bg_x, bg_sep, selections, lane_angle=0.0, lane_bend=None, cache=None, profiles=None):
+	if profiles is None:
+		profiles = lane_profiles(first_x, first_y, lane_length, lane_sep, lane_width, lane_count, lane_direction, imp,
+								lane_angle, lane_bend, cache)
+	entry = None
+	if cache is not None:
+		key = ["background", image_hash(imp), first_x, first_y, lane_length, lane_sep, lane_width, lane_count,
+				lane_direction, lane_angle or 0.0, list(lane_bend or []), bg_x, bg_sep]
+		entry = cache.get(key)
+	if entry is not None:
+		a, b, c = entry["plane"]
+		adj_profiles = entry["adj_profiles"]
+	else:
+		a, b, c = extract_background(bg_x, bg_sep, first_y, lane_length, lane_direction, lane_count,
+									lane_sep, lane_width, imp)
+		adj_profiles = subtract_background(profiles, a, b, c, first_x, lane_sep, lane_width, lane_direction, lane_angle,
+											lane_bend)
+		if cache is not None:
+			cache.put(key, {"plane": [a, b, c], "adj_profiles": adj_profiles})
+	adj_prefix_sums = prefix_sums(adj_profiles)
+	return {"profiles": profiles, "plane": (a, b, c), "adj_profiles": adj_profiles, "adj_prefix_sums": adj_prefix_sums,
+			"sums": measure_selections(adj_prefix_sums, selections)}
+
+# measure_gel() of every slice of a stack (see load_stack()) with the same lanes, background lines and selection
+# areas, the lanes of all slices are sampled in one pass and the background plane is fitted per slice
+# progress: see stack_profiles()
+def measure_stack(imps, first_x, first_y, lane_length, lane_sep, lane_width, lane_count, lane_direction,
+				bg_x, bg_sep, selections, lane_angle=0.0, lane_bend=None, cache=None, progress=None):
+	profiles = stack_profiles(first_x, first_y, lane_length, lane_sep, lane_width, lane_count, lane_direction, imps,
+							lane_angle, lane_bend, cache, progress)
+	return [measure_gel(imp, first_x, first_y, lane_length, lane_sep, lane_width, lane_count, lane_direction, bg_x,
+						bg_sep, selections, lane_angle, lane_bend, cache, slice_profiles)
+			for imp, slice_profiles in zip(imps, profiles)]
+
+# Parameters:
+# lane_direction: "vertical" / "horizontal"
+# progress: see stack_profiles(), called every 256 rows
+# returns the gel summed along the lane direction, one value per position across the lanes, the rows are read
+# in bulk in one pass, see pixel_rows()
+def lane_projection(imp, lane_direction, progress=None):
+	if isinstance(imp, InvertedImage): # every pixel is max_value - value
+		count = imp.getHeight() if lane_direction == "vertical" else imp.getWidth()
+		return [count*imp.max_value - value for value in lane_projection(imp.image, lane_direction, progress)]
+	if progress is None:
+		progress = lambda done, total: None
+	height = imp.getHeight()
+	projection = [] if lane_direction == "horizontal" else [0.0] * imp.getWidth()
+	for y, row in enumerate(pixel_rows(imp)):
+		if y % 256 == 0:
+			progress(y, height)
+		if lane_direction == "vertical":
+			projection = list(map(operator.add, projection, row))
+		else: # row sums
+			projection.append(sum(row))
+	return projection
+
+# rows of an image in order as sequences of pixel values: slices of the pixels of a PixelImage, blocks of rows of
+# a MappedImage and the rows of the processor of an ImagePlus (see imagej_rows()), a row is only valid until the
+# next one is read
+def pixel_rows(imp):
+	if IJ is not None and isinstance(imp, ImagePlus):
+		for row in imagej_rows(imp.getProcessor()):
+			yield row
+	elif isinstance(imp, MappedImage):
+		for y in range(0, imp.height, 256):
+			for row in pixel_rows(imp.region(0, y, imp.width, min(y + 256, imp.height))):
+				yield row
+	else:
+		width = imp.width
+		for y in range(imp.height):
+			yield imp.pixels[y*width:(y + 1)*width]
+
+# rows of an ImageJ processor read into one reused float array, RGB pixels as the mean of their channels as in
+# ImageJ's profiles
+def imagej_rows(ip):
+	from jarray import zeros
+	width = ip.getWidth()
+	if isinstance(ip, ColorProcessor):
+		row = zeros(width, "i")
+		for y in range(ip.getHeight()):
+			ip.getRow(0, y, row, width)
+			yield [((c >> 16 & 0xff) + (c >> 8 & 0xff) + (c & 0xff)) / 3.0 for c in row]
+	else:
+		row = zeros(width, "f")
+		for y in range(ip.getHeight()):
+			ip.getRow(0, y, row, width)
+			yield row
+
+# moving average over 2*radius + 1 values, shortened at the ends
+def smooth_profile(values, radius):
+	prefix = prefix_sums([values])[0]
+	n = len(values)
+	return [(prefix[min(n, j + radius + 1)] - prefix[max(0, j - radius)]) / (min(n, j + radius + 1) - max(0, j - radius))
+			for j in range(n)]
+
+# values minus their least squares line, a tilted background projects to a linear trend
+def detrend(values):
+	n = len(values)
+	mean_j = 0.5 * (n - 1)
+	mean = sum(values) / float(n)
+	slope = sum((j - mean_j) * (value - mean) for j, value in enumerate(values)) / max(1.0, sum((j - mean_j)**2 for j in range(n)))
+	return [value - mean - slope*(j - mean_j) for j, value in enumerate(values)]
+
+# lane spacing in pixels (with sub-pixel precision) from the autocorrelation of the detrended projection, its first
+# peak after the central one that reaches 70 % of the highest peak, None if the projection is not periodic
+# the autocorrelation takes quadratic time, so a projection longer than max_points is binned to at most max_points
+# values first and only the lags around the period found in the bins are correlated at full resolution
+def lane_period(centered, max_points=1024):
+	n = len(centered)
+	factor = -(-n // max_points)
+	if factor > 1:
+		bins = [sum(centered[k:k + factor]) for k in range(0, n - factor + 1, factor)]
+		period = lane_period(bins, max_points)
+		if period is None:
+			return None
+		lags = range(max(1, int(period*factor) - factor - 1), min(n // 2, int(period*factor) + factor + 2) + 1)
+		correlation = dict((lag, sum(map(operator.mul, centered, centered[lag:])) / (n - lag)) for lag in lags)
+		lag = max(lags[1:-1], key=lambda lag: correlation[lag])
+		before, value, after = correlation[lag - 1], correlation[lag], correlation[lag + 1]
+		curvature = before - 2*value + after
+		return lag + (0.5 * (before - after) / curvature if curvature < 0 else 0.0)
+	if n < 8:
+		return None
+	correlation = [sum(map(operator.mul, centered, centered[lag:])) / (n - lag) for lag in range(n // 2 + 1)]
+	start = 1
+	while start < len(correlation) and correlation[start] > 0:
+		start += 1
+	if start >= len(correlation) - 1:
+		return None
+	highest = max(correlation[start:])
+	if highest <= 0:
+		return None
+	for lag in range(start + 1, len(correlation) - 1):
+		before, value, after = correlation[lag - 1], correlation[lag], correlation[lag + 1]
+		if value >= 0.7 * highest and value >= before and value >= after:
+			curvature = before - 2*value + after
+			return lag + (0.5 * (before - after) / curvature if curvature < 0 else 0.0)
+	return None
+
+# positions of the lanes in a smoothed projection with the given lane spacing, the longest run of regularly
+# spaced peaks standing out at least 5 % of the strongest lane from the gaps next to them
+# returns a list of (center, width) of the lanes measured at half the peak height
+def lane_peaks(profile, period):
+	n = len(profile)
+	comb = lambda phase: [int(round(phase + i*period)) for i in range(int((n - 1 - phase) / period) + 1)]
+	phase = max(range(int(period)), key=lambda phase: sum(profile[j] for j in comb(phase)))
+	
+	reach = max(1, int(period / 4))
+	gap = max(1, int(period / 2))
+	peaks = []
+	for j in comb(phase):
+		window = range(max(0, j - reach), min(n, j + reach + 1))
+		center = max(window, key=lambda k: profile[k])
+		sides = [min(profile[max(0, center - gap):center] or [None]), min(profile[center + 1:center + gap + 1] or [None])]
+		base = max(side for side in sides if side is not None) if sides != [None, None] else profile[center]
+		peaks.append((center, profile[center] - base, base))
+	strongest = max(prominence for center, prominence, base in peaks)
+	if strongest <= 0:
+		return []
+	
+	runs = [[]]
+	for peak in peaks:
+		if peak[1] >= 0.05 * strongest:
+			runs[-1].append(peak)
+		elif runs[-1]:
+			runs.append([])
+	lanes = []
+	for center, prominence, base in max(runs, key=len):
+		level = base + 0.5 * prominence
+		left = center
+		while left > max(0, center - gap) and profile[left - 1] > level:
+			left -= 1
+		right = center
+		while right < min(n - 1, center + gap) and profile[right + 1] > level:
+			right += 1
+		lanes.append((0.5 * (left + right), right - left + 1))
+	return lanes
+
+# Parameters:
+# imp: inverted analysis image, see load_image()
+# lane_direction: "vertical" / "horizontal"
+# returns the first lane position (first_x for vertical lanes, first_y for horizontal ones), lane_sep, lane_count
+# and lane_width as a partial parameter set, None if no regularly spaced lanes are found
+# cache: optional ResultCache keeping the detected lanes of the gel
+# progress: see stack_profiles()
+@stage("detect_lanes")
+def detect_lanes(imp, lane_direction, cache=None, progress=None):
+	if cache is not None:
+		if progress is not None:
+			progress(0, 1) # hashing may read the whole image, a cancelled task stops before
+		key = ["lanes", image_hash(imp), lane_direction]
+		entry = cache.get(key)
+		if entry is None:
+			entry = {"lanes": detect_lanes(imp, lane_direction, progress=progress)}
+			cache.put(key, entry)
+		return entry["lanes"]
+	projection = detrend(lane_projection(imp, lane_direction, progress))
+	period = lane_period(projection)
+	if period is None:
+		return None
+	lanes = lane_peaks(smooth_profile(projection, max(1, int(period / 8))), period)
+	if len(lanes) < 2:
+		return None
+	
+	# least squares fit of center = first + i*lane_sep
+	count = len(lanes)
+	mean_i = 0.5 * (count - 1)
+	mean_center = sum(center for center, width in lanes) / float(count)
+	lane_sep = (sum((i - mean_i) * (lanes[i][0] - mean_center) for i in range(count)) /
+				sum((i - mean_i)**2 for i in range(count)))
+	first = mean_center - lane_sep * mean_i
+	lane_width = sum(width for center, width in lanes) / float(count)
+	
+	lane_sep = int(round(lane_sep))
+	params = {"lane_sep": lane_sep, "lane_count": count, "lane_width": max(1, min(lane_sep, int(round(lane_width))))}
+	params["first_x" if lane_direction == "vertical" else "first_y"] = int(round(first))
+	return params
+
+# standard deviation of the noise of a profile from the median absolute difference of neighbouring values,
+# which bands and a tilted background hardly change
+def noise_level(values):
+	differences = sorted(abs(b - a) for a, b in zip(values, values[1:]))
+	if not differences:
+		return 0.0
+	return differences[len(differences) // 2] / (0.6745 * math.sqrt(2))
+
+# local maxima of a profile, the middle of flat tops, a maximum at either end counts
+def local_maxima(values):
+	n = len(values)
+	maxima = []
+	j = 0
+	while j < n:
+		k = j
+		while k + 1 < n and values[k + 1] == values[j]:
+			k += 1
+		if (j == 0 or values[j - 1] < values[j]) and (k == n - 1 or values[k + 1] < values[j]) and n > 1:
+			maxima.append((j + k) // 2)
+		j = k + 1
+	return maxima
+
+# height of a peak above the higher of the lowest points on either side before a higher value
+def prominence(values, j):
+	bases = []
+	for step in [-1, 1]:
+		lowest = values[j]
+		k = j + step
+		while 0 <= k < len(values) and values[k] <= values[j]:
+			lowest = min(lowest, values[k])
+			k += step
+		bases.append(lowest)
+	return values[j] - max(bases)
+
+# Parameters:
+# adj_profiles: background-subtracted profiles of all lanes, see subtract_background()
+# radius: of the moving average smoothing the lanes, by default 1/200 of the lane length
+# returns selection areas [left_bound, right_bound] around the bands, sorted along the lanes
+# bands are found in the sum of all lanes, so each area covers a band at the same position in every lane; a band is a
+# peak standing out from its surroundings by min_fraction of the strongest band and by 4 noise levels, its area ends
+# where the smoothed lanes fall to 5 % of its height above its surroundings or at the lowest point between it and
+# the next band
+@stage("detect_bands")
+def detect_bands(adj_profiles, radius=None, min_fraction=0.05):
+	combined = [sum(values) for values in zip(*adj_profiles)]
+	n = len(combined)
+	if n < 3:
+		return []
+	if radius is None:
+		radius = max(1, n // 200)
+	smoothed = smooth_profile(combined, radius)
+	
+	peaks = [(j, prominence(smoothed, j)) for j in local_maxima(smoothed)]
+	if not peaks:
+		return []
+	threshold = max(min_fraction * max(height for j, height in peaks),
+					4 * noise_level(combined) / math.sqrt(2*radius + 1))
+	bands = [(j, height) for j, height in peaks if height >= threshold and height > 0]
+	centers = [j for j, height in bands]
+	
+	valleys = [0]
+	for left, right in zip(centers, centers[1:]):
+		valleys.append(min(range(left, right + 1), key=lambda k: smoothed[k]))
+	valleys.append(n - 1)
+	areas = []
+	for i in range(len(bands)):
+		center, height = bands[i]
+		level = smoothed[center] - 0.95 * height
+		left = center
+		while left > valleys[i] and smoothed[left - 1] > level:
+			left -= 1
+		right = center
+		while right < valleys[i + 1] and smoothed[right + 1] > level:
+			right += 1
+		areas.append([left, right + 1])
+	return areas
+
+# detect_bands() of every slice of a stack, areas of different slices which overlap are merged into one, so that
+# the bands of all labels of a gel are measured in every slice
+def detect_stack_bands(slice_adj_profiles):
+	area_lists = [detect_bands(adj_profiles) for adj_profiles in slice_adj_profiles]
+	if len(area_lists) == 1:
+		return area_lists[0]
+	merged = []
+	for left, right in sorted(area for areas in area_lists for area in areas):
+		if merged and left < merged[-1][1]:
+			merged[-1][1] = max(merged[-1][1], right)
+		else:
+			merged.append([left, right])
+	return merged
+
+# profile along a line averaged over the given width
+# imp is either an ImagePlus or a PixelImage when running without ImageJ,
+# profiles are shared through PROFILE_CACHE and must not be modified by the caller
+def sample_line(imp, x1, y1, x2, y2, width=None):
+	key = (imp.getID(), x1, y1, x2, y2, width)
+	profile = PROFILE_CACHE.get(key)
+	if profile is None:
+		profile = line_profile(imp, x1, y1, x2, y2, width)
+		PROFILE_CACHE.put(key, profile)
+	return profile
+
+# uncached version of sample_line(), wide lines are the average of one pixel wide lines shifted perpendicularly
+# to the line, the pixels are only read so that several threads can sample the same image, of a MappedImage only
+# the region around the line is read
+# lines of an ImagePlus are sampled by ImageJ, see imagej_line_profile()
+def line_profile(imp, x1, y1, x2, y2, width=None):
+	if isinstance(imp, InvertedImage):
+		return imp.lineProfile(x1, y1, x2, y2, width)
+	if IJ is not None and isinstance(imp, ImagePlus):
+		return imagej_line_profile(imp, x1, y1, x2, y2, width)
+	width = width or 1
+	dx = x2 - x1
+	dy = y2 - y1
+	length = math.sqrt(dx*dx + dy*dy)
+	if length > 0:
+		normal_x, normal_y = -dy / length, dx / length
+	else:
+		normal_x, normal_y = 0.0, 0.0
+	
+	lines = []
+	for k in range(width):
+		offset = k - 0.5*(width - 1)
+		lines.append((x1 + offset*normal_x, y1 + offset*normal_y, x2 + offset*normal_x, y2 + offset*normal_y))
+	if isinstance(imp, MappedImage):
+		imp = imp.lineRegion(lines)
+		x0, y0 = imp.origin
+		lines = [(lx1 - x0, ly1 - y0, lx2 - x0, ly2 - y0) for lx1, ly1, lx2, ly2 in lines]
+	lines = [thin_line(imp, lx1, ly1, lx2, ly2) for lx1, ly1, lx2, ly2 in lines]
+	if width == 1:
+		return list(lines[0])
+	return [sum(values) / width for values in zip(*lines)]
+
+# ImageJ's profile of a straight line as shown by Analyze > Plot Profile (wide lines are straightened with
+# interpolation and averaged across), taken on a private ImagePlus sharing the pixels of imp, so that the ROI of
+# imp is never set and several threads can sample it at once
+def imagej_line_profile(imp, x1, y1, x2, y2, width=None):
+	view = ImagePlus("Lane", pixel_view(imp.getProcessor()))
+	roi = Line(x1, y1, x2, y2)
+	if width is not None:
+		roi.setStrokeWidth(width)
+	view.setRoi(roi)
+	return list(ProfilePlot(view).getProfile())
+
+# processor of the same type as ip reading its pixel array, nothing is copied
+def pixel_view(ip):
+	width, height, pixels = ip.getWidth(), ip.getHeight(), ip.getPixels()
+	if isinstance(ip, ColorProcessor):
+		return ColorProcessor(width, height, pixels)
+	if isinstance(ip, FloatProcessor):
+		return FloatProcessor(width, height, pixels, ip.getColorModel())
+	if isinstance(ip, ShortProcessor):
+		return ShortProcessor(width, height, pixels, ip.getColorModel())
+	return ByteProcessor(width, height, pixels, ip.getColorModel())
+
+# nearest pixel values along a one pixel wide line, read from the pixel buffer
+def thin_line(imp, x1, y1, x2, y2):
+	return imp.getLine(x1, y1, x2, y2)
+
+# least recently used cache of sampled profiles keyed by (image ID, line end points, stroke width), shared by
+# lane sampling, background sampling and background removal as well as going back and forth between the windows
+class ProfileCache(object):
+	def __init__(self, max_entries):
+		self.max_entries = max_entries
+		self.profiles = OrderedDict()
+		self.lock = threading.Lock() # batch workers share the cache in Jython
+	
+	def get(self, key):
+		with self.lock:
+			profile = self.profiles.pop(key, None)
+			if profile is not None:
+				self.profiles[key] = profile
+			return profile
+	
+	def put(self, key, profile):
+		with self.lock:
+			self.profiles.pop(key, None)
+			self.profiles[key] = profile
+			while len(self.profiles) > self.max_entries:
+				self.profiles.popitem(last=False)
+	
+	def clear(self):
+		with self.lock:
+			self.profiles.clear()
+
+PROFILE_CACHE = ProfileCache(256)
+# LaneGrid of the last lane shapes, building one takes longer than sampling all lanes with it
+GRID_CACHE = ProfileCache(16)
+
+# bump when a change of the engine changes sampled profiles or fitted planes, entries of older versions are then
+# never read again and get evicted
+RESULT_CACHE_VERSION = 2
+RESULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".emsa_cache")
+# image_hash() of the analysis images by their ID, their pixels never change (as for PROFILE_CACHE)
+IMAGE_HASHES = ProfileCache(64)
+
+# SHA-1 of the pixel values of an analysis image, the same gel opened again has the same hash, a MappedImage is
+# identified by its file instead (see MappedImage)
+def image_hash(imp):
+	if isinstance(imp, InvertedImage):
+		return hashlib.sha1(("inverted %r %s" % (imp.max_value, image_hash(imp.image))).encode("ascii")).hexdigest()
+	if isinstance(imp, PixelImage):
+		digest = IMAGE_HASHES.get(imp.getID())
+		if digest is None:
+			pixels = imp.pixels if isinstance(imp.pixels, array) else array("d", imp.pixels)
+			data = pixels.tobytes() if hasattr(pixels, "tobytes") else pixels.tostring()
+			digest = hashlib.sha1(("%s %d %d " % (pixels.typecode, imp.width, imp.height)).encode("ascii") + data).hexdigest()
+			IMAGE_HASHES.put(imp.getID(), digest)
+		return digest
+	if isinstance(imp, MappedImage): # an unchanged file has the same hash, only its layout is read
+		digest = IMAGE_HASHES.get(imp.getID())
+		if digest is None:
+			sha = hashlib.sha1(("mapped %s %d %d %d %r %r " % (imp.code, imp.samples, imp.width, imp.height, imp.scale,
+															imp.max_value)).encode("ascii"))
+			if imp.source is not None:
+				sha.update(json.dumps(list(imp.source)).encode("utf-8"))
+			else: # raw samples read block by block
+				for y in range(0, imp.height, 256):
+					raw = imp.rawRegion(0, y, imp.width, min(y + 256, imp.height))
+					sha.update(raw.tobytes() if hasattr(raw, "tobytes") else raw.tostring())
+			digest = sha.hexdigest()
+			IMAGE_HASHES.put(imp.getID(), digest)
+		return digest
+	
+	digest = IMAGE_HASHES.get(imp.getID())
+	if digest is None:
+		digest = imagej_hash(imp)
+		IMAGE_HASHES.put(imp.getID(), digest)
+	return digest
+
+# image_hash() of an ImagePlus, the pixels are fed to the digest in blocks of rows so that large scans are never
+# copied as a whole
+def imagej_hash(imp):
+	from java.nio import ByteBuffer
+	from java.security import MessageDigest
+	ip = imp.getProcessor()
+	pixels = ip.getPixels()
+	bit_depth = imp.getBitDepth()
+	digest = MessageDigest.getInstance("SHA-1")
+	digest.update(("%d %d %d " % (bit_depth, ip.getWidth(), ip.getHeight())).encode("ascii"))
+	if bit_depth == 8:
+		digest.update(pixels)
+	else:
+		size = {16: 2, 24: 4, 32: 4}[bit_depth]
+		block = 256 * ip.getWidth()
+		buffer = ByteBuffer.allocate(min(block, len(pixels)) * size)
+		views = {16: buffer.asShortBuffer, 24: buffer.asIntBuffer, 32: buffer.asFloatBuffer}
+		for start in range(0, len(pixels), block):
+			length = min(block, len(pixels) - start)
+			views[bit_depth]().put(pixels, start, length)
+			digest.update(buffer.array(), 0, length * size)
+	return "".join(["%02x" % (byte & 0xff) for byte in digest.digest()])
+
+# results kept on disk between sessions as one JSON file per entry, the least recently used entries are removed
+# once the files take more than max_bytes
+# keys are JSON-serialisable lists, see lane_profiles() and measure_gel() for the entries
+class ResultCache(object):
+	def __init__(self, directory=RESULT_CACHE_DIR, max_bytes=256 * 1024 * 1024):
+		self.directory = directory
+		self.max_bytes = max_bytes
+	
+	def path(self, key):
+		name = hashlib.sha1(json.dumps([RESULT_CACHE_VERSION, key], sort_keys=True).encode("utf-8")).hexdigest()
+		return os.path.join(self.directory, name + ".json")
+	
+	def get(self, key):
+		path = self.path(key)
+		try:
+			f = open(path)
+			try:
+				value = json.load(f)
+			finally:
+				f.close()
+			os.utime(path, None) # marks the entry as recently used
+		except (IOError, OSError, ValueError):
+			return None
+		return value
+	
+	def put(self, key, value):
+		try:
+			write_file(self.path(key), json.dumps(value))
+			self.evict()
+		except (IOError, OSError): # a full or read-only disk only costs the caching
+			pass
+	
+	def evict(self):
+		entries = []
+		for name in os.listdir(self.directory):
+			if name.endswith(".json"):
+				try:
+					stat = os.stat(os.path.join(self.directory, name))
+				except OSError: # removed by another process meanwhile
+					continue
+				entries.append((stat.st_mtime, stat.st_size, name))
+		total = sum(size for modified, size, name in entries)
+		for modified, size, name in sorted(entries):
+			if total <= self.max_bytes:
+				break
+			try:
+				os.remove(os.path.join(self.directory, name))
+			except OSError:
+				pass
+			total -= size
+
+# appending store of the results of many gels in an indexed SQLite database, one row per analysis (of every slice
+# of a stack) in gels and one row per lane and selection area in sums, analyses are never overwritten and
+# latest_sums shows the most recent analysis of every gel file, e.g.
+#   SELECT path, slice, lane, area, adjusted_sum FROM latest_sums WHERE area = 1 ORDER BY path, slice, lane
+RESULT_STORE_SCHEMA = [
+	"CREATE TABLE IF NOT EXISTS gels (id TEXT PRIMARY KEY, path TEXT NOT NULL, image_hash TEXT, analysed REAL, "
+	"method TEXT, native INTEGER, parameters TEXT, plane_a REAL, plane_b REAL, plane_c REAL, slice INTEGER DEFAULT 1, "
+	"slice_label TEXT)",
+	"CREATE TABLE IF NOT EXISTS sums (gel_id TEXT NOT NULL REFERENCES gels (id), lane INTEGER, area INTEGER, "
+	"left_bound INTEGER, right_bound INTEGER, raw_sum REAL, adjusted_sum REAL)",
+	"CREATE INDEX IF NOT EXISTS gels_path ON gels (path, analysed)",
+	"CREATE INDEX IF NOT EXISTS gels_image_hash ON gels (image_hash)",
+	"CREATE INDEX IF NOT EXISTS sums_gel ON sums (gel_id, lane, area)",
+	"CREATE VIEW IF NOT EXISTS latest_sums AS SELECT gels.path, gels.slice, gels.slice_label, gels.image_hash, "
+	"gels.analysed, gels.method, gels.plane_a, gels.plane_b, gels.plane_c, sums.lane, sums.area, sums.left_bound, sums.right_bound, "
+	"sums.raw_sum, sums.adjusted_sum FROM gels JOIN sums ON sums.gel_id = gels.id "
+	"WHERE gels.analysed = (SELECT MAX(analysed) FROM gels AS newer WHERE newer.path = gels.path)"]
+
+# result store the windows append every saved measurement to, kept in the folder of the saved results
+RESULT_STORE_NAME = "emsa_results.sqlite"
+
+# sqlite3 in CPython, in Jython (which has no sqlite3) through zxJDBC and the SQLite JDBC driver
+def connect_database(path):
+	try:
+		import sqlite3
+	except ImportError:
+		from com.ziclix.python.sql import zxJDBC
+		return zxJDBC.connect("jdbc:sqlite:" + path, None, None, "org.sqlite.JDBC")
+	return sqlite3.connect(path, timeout=60)
+
+# record of one analysed gel (or one slice of it) for ResultStore.addGels()
+# sums, raw_sums: one list per lane with the sum of every selection area after and before background subtraction
+# analysed: time of the analysis, the same for all slices of a gel
+def store_record(path, imp, params, native, method, plane, selections, raw_sums, sums, slice_number=1,
+				slice_label=None, analysed=None):
+	return {"path": os.path.abspath(path), "image_hash": image_hash(imp), "analysed": analysed or time.time(),
+			"method": method, "native": native, "parameters": params, "plane": list(plane), "selections": selections,
+			"raw_sums": raw_sums, "sums": sums, "slice": slice_number, "slice_label": slice_label}
+
+class ResultStore(object):
+	def __init__(self, path):
+		self.path = path
+		self.connection = connect_database(path)
+		cursor = self.connection.cursor()
+		for statement in RESULT_STORE_SCHEMA:
+			cursor.execute(statement)
+		self.connection.commit()
+	
+	# inserts the records of store_record() in one transaction, with one bulk insert per table
+	def addGels(self, records):
+		gel_rows = []
+		sum_rows = []
+		for record in records:
+			gel_id = uuid.uuid4().hex
+			a, b, c = record["plane"]
+			gel_rows.append((gel_id, record["path"], record["image_hash"], record["analysed"], record["method"],
+							int(record["native"]), json.dumps(record["parameters"], sort_keys=True), a, b, c,
+							record["slice"], record["slice_label"]))
+			for i in range(len(record["sums"])):
+				for j, (left, right) in enumerate(record["selections"]):
+					sum_rows.append((gel_id, i + 1, j + 1, left, right, record["raw_sums"][i][j], record["sums"][i][j]))
+		cursor = self.connection.cursor()
+		try:
+			cursor.executemany("INSERT INTO gels (id, path, image_hash, analysed, method, native, parameters, plane_a, "
+								"plane_b, plane_c, slice, slice_label) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+								gel_rows)
+			if sum_rows:
+				cursor.executemany("INSERT INTO sums VALUES (?, ?, ?, ?, ?, ?, ?)", sum_rows)
+		except Exception:
+			self.connection.rollback()
+			raise
+		self.connection.commit()
+	
+	# rows of a query, e.g. of the latest_sums view
+	def query(self, statement, parameters=()):
+		cursor = self.connection.cursor()
+		cursor.execute(statement, parameters)
+		return cursor.fetchall()
+	
+	def close(self):
+		self.connection.close()
+
+# normal equation moments (n, sum_x, sum_y, sum_z, sum_xx, sum_yy, sum_xy, sum_xz, sum_yz) of one background
+# column at absolute x with relative y = 0 to y = len(z_list), the z sums are bulk reductions and the rest is analytic
+def column_moments(x, z_list):
+	n = len(z_list)
+	sum_y = n*(n - 1)/2
+	sum_z = sum(z_list)
+	sum_yz = sum(map(operator.mul, range(n), z_list))
+	return (n, x*n, sum_y, sum_z, x**2 * n, (2 * n**3 - 3 * n**2 + n)/6, x*sum_y, x*sum_z, sum_yz)
+
 # function based on Gwyddion level.c module, Copyright (C) David Necas (Yeti), Petr Klapetek
 # values: dict with for each absolute x, a list of values with relative y = 0 to y = len(list)
 def fit_plane(values):
-	sum_x = 0
-	sum_y = 0
-	sum_z = 0
-	sum_xx = 0
-	sum_yy = 0
-	sum_xy = 0
-	sum_xz = 0
-	sum_yz = 0
-	n = 0
-
-	for x, z_list in values.items():
-		sum_x += x*len(z_list)
-		sum_xx += x**2 * len(z_list)
-		sum_y += len(z_list)*(len(z_list) - 1)/2
-		sum_yy += (2 * len(z_list)**3 - 3 * len(z_list)**2 + len(z_list))/6
-		n += len(z_list)
-		y = 0
-		for z in z_list:
-			sum_z += z
-			sum_xy += x*y
-			sum_xz += x*z
-			sum_yz += y*z
-			y += 1
+	return fit_moments([column_moments(x, z_list) for x, z_list in values.items()])
+
+# plane fitted to the column_moments() of the background columns, timed as the fit_plane stage since
+# extract_background() fits the moments it keeps without fit_plane()
+@stage("fit_plane")
+def fit_moments(column_list):
+	return solve_plane(sum_moments(column_list))
+
+# adds up column_moments() of several background columns
+def sum_moments(column_list):
+	moments = [0] * 9
+	for column in column_list:
+		moments = [total + m for total, m in zip(moments, column)]
+	return moments
+
+# solves the normal equations of the plane fit for moments summed over all background columns
+def solve_plane(moments):
+	n, sum_x, sum_y, sum_z, sum_xx, sum_yy, sum_xy, sum_xz, sum_yz = moments
 	
 	det = (n*sum_xx*sum_yy) + (2*sum_x*sum_xy*sum_y) - (sum_x*sum_x*sum_yy) -(sum_y*sum_y*sum_xx) - (n*sum_xy*sum_xy)
 	if det == 0:
@@ -485,6 +2013,805 @@ def fit_plane(values):
 	return a, b, c
 
 
+# inverted copy of an RGB processor, so that gel bands are peaks in the lane profiles
+def analysis_image(ip):
+	analysis_ip = ip.duplicate()
+	analysis_ip.invert()
+	return ImagePlus("Analysis", analysis_ip)
+
+# downsampled copy of a gel shown in the lane overview and its scale (full resolution pixels per overview pixel),
+# the gel is halved (averaging the pixels) while it is still at least twice the screen size, i.e. the overview
+# is never coarser than the zoom ImageJ shows the whole gel at, so that large scans are neither kept as a second
+# full resolution RGB copy nor scaled down on every redraw, gels smaller than that are shown as they are
+@stage("preview_image")
+def preview_image(ip):
+	screen = IJ.getScreenSize()
+	level = preview_level(ip.getWidth(), ip.getHeight(), screen.width, screen.height)
+	preview = ip
+	for k in range(level):
+		preview = preview.resize(max(1, preview.getWidth() // 2), max(1, preview.getHeight() // 2), True)
+	if level and ip.getBitDepth() != 24:
+		preview.setMinAndMax(ip.getMin(), ip.getMax())
+	return preview, 2**level
+
+# number of times an image is halved for the lane overview of a max_width x max_height screen
+def preview_level(width, height, max_width, max_height):
+	level = 0
+	while width >= 2*max_width or height >= 2*max_height:
+		width //= 2
+		height //= 2
+		level += 1
+	return level
+
+# value ImageProcessor.invert() subtracts from, 32-bit images are inverted within their range of values
+def inversion_max(ip):
+	bit_depth = ip.getBitDepth()
+	if bit_depth == 16:
+		return 65535
+	if bit_depth == 32:
+		return ip.getStatistics().max
+	return 255
+
+# opens a gel file for the headless engine and returns the inverted image used for analysis,
+# with ImageJ available the same RGB conversion as in the GUI is used unless native is set,
+# plain CPython always works on the native pixel values
+@stage("load_image")
+def load_image(path, native=False):
+	if IJ is not None:
+		imp = IJ.openImage(path)
+		if imp is None:
+			raise IOError("Cannot open " + path)
+		if native:
+			return InvertedImage(imp, inversion_max(imp.getProcessor()))
+		return analysis_image(imp.getProcessor().convertToRGB())
+	image = map_tiff_stack(path, 1)[0]
+	return InvertedImage(image, image.max_value)
+
+# load_image() of every slice (or channel or frame) of a gel file, returns the analysis images and their labels
+@stage("load_stack")
+def load_stack(path, native=False):
+	if IJ is not None:
+		imp = IJ.openImage(path)
+		if imp is None:
+			raise IOError("Cannot open " + path)
+		return stack_images(imp, native)
+	images = map_tiff_stack(path)
+	return [InvertedImage(image, image.max_value) for image in images], [str(k + 1) for k in range(len(images))]
+
+# analysis images of all slices of an ImagePlus, converted the same way as by load_image(), and their labels,
+# the slice number followed by the first line of the slice label (e.g. the channel name) if there is one
+@stage("stack_images")
+def stack_images(imp, native=False):
+	stack = imp.getStack()
+	images = []
+	labels = []
+	for n in range(1, stack.getSize() + 1):
+		ip = stack.getProcessor(n)
+		if native:
+			images.append(InvertedImage(ImagePlus("Analysis " + str(n), ip), inversion_max(ip)))
+		else:
+			images.append(analysis_image(ip.convertToRGB()))
+		label = stack.getShortSliceLabel(n)
+		labels.append(str(n) + (" " + label.replace("\t", " ") if label else ""))
+	return images, labels
+
+
+# inverted view of an ImagePlus or PixelImage without an inverted copy of the pixels, the inversion
+# max_value - value is applied to every sampled profile, which equals sampling the inverted image
+class InvertedImage(object):
+	def __init__(self, image, max_value):
+		self.image = image
+		self.max_value = max_value
+	
+	def getID(self):
+		return ("inverted", self.image.getID())
+	
+	def getWidth(self):
+		return self.image.getWidth()
+	
+	def getHeight(self):
+		return self.image.getHeight()
+	
+	def lineProfile(self, x1, y1, x2, y2, width=None):
+		max_value = self.max_value
+		return [max_value - value for value in line_profile(self.image, x1, y1, x2, y2, width)]
+
+
+# minimal single channel image used by the engine when running in plain CPython,
+# pixel values are stored row by row in one flat array
+class PixelImage(object):
+	ids = count(1)
+	
+	def __init__(self, width, height, pixels, max_value):
+		self.width = width
+		self.height = height
+		self.pixels = pixels
+		self.max_value = max_value
+		self.id = next(PixelImage.ids)
+		self.line_size = (width, height) # size of the image a region was read from, see getLine()
+		self.origin = (0, 0) # position in that image
+	
+	# unique for every image like ImagePlus.getID(), used as the image identity in PROFILE_CACHE
+	def getID(self):
+		return self.id
+	
+	def getWidth(self):
+		return self.width
+	
+	def getHeight(self):
+		return self.height
+	
+	# nearest pixel value, zero outside of the image as in ImageJ
+	def getValue(self, x, y):
+		ix = int(math.floor(x + 0.5))
+		iy = int(math.floor(y + 0.5))
+		if 0 <= ix < self.width and 0 <= iy < self.height:
+			return self.pixels[iy * self.width + ix]
+		return 0.0
+	
+	# same points as ImageProcessor.getLine() without interpolation, lanes along the rows or columns are read as slices
+	def getLine(self, x1, y1, x2, y2):
+		dx = x2 - x1
+		dy = y2 - y1
+		n = int(math.floor(math.sqrt(dx*dx + dy*dy) + 0.5))
+		xinc = dx / float(n) if n > 0 else 0.0
+		yinc = dy / float(n) if n > 0 else 0.0
+		if not ((xinc == 0 and n == self.line_size[1]) or (yinc == 0 and n == self.line_size[0])):
+			n += 1
+		
+		width = self.width
+		ix = int(math.floor(x1 + 0.5))
+		iy = int(math.floor(y1 + 0.5))
+		if xinc == 0 and yinc == 1:
+			if not 0 <= ix < width:
+				return [0.0] * n
+			start, stop = max(iy, 0), min(iy + n, self.height)
+			values = [0.0] * n
+			if start < stop:
+				values[start - iy:stop - iy] = self.pixels[start*width + ix:(stop - 1)*width + ix + 1:width]
+			return values
+		if yinc == 0 and xinc == 1:
+			if not 0 <= iy < self.height:
+				return [0.0] * n
+			start, stop = max(ix, 0), min(ix + n, width)
+			values = [0.0] * n
+			if start < stop:
+				values[start - ix:stop - ix] = self.pixels[iy*width + start:iy*width + stop]
+			return values
+		return [self.getValue(x1 + i*xinc, y1 + i*yinc) for i in range(n)]
+
+
+# TIFF field types, rationals are read as two unsigned/signed longs
+TIFF_TYPES = {1: "B", 2: "c", 3: "H", 4: "I", 5: "II", 6: "b", 7: "B", 8: "h", 9: "i", 10: "ii", 11: "f", 12: "d"}
+# (bits per sample, sample format) to array type code
+TIFF_PIXEL_TYPES = {(8, 1): "B", (16, 1): "H", (32, 1): "I", (8, 2): "b", (16, 2): "h", (32, 2): "i",
+					(32, 3): "f", (64, 3): "d"}
+MD_FILETAG = 33445 # Molecular Dynamics .gel tags, 2 means square root encoded data
+MD_SCALEPIXEL = 33446
+
+# reads the first image of an uncompressed grayscale or RGB (averaged) .tif/.gel file into a PixelImage
+def read_tiff(path):
+	return read_tiff_stack(path, 1)[0]
+
+# reads the images of a multi-page .tif/.gel file (e.g. the channels of a scan or an ImageJ stack), at most
+# max_pages of them
+def read_tiff_stack(path, max_pages=None):
+	return [image.region(0, 0, image.width, image.height) for image in map_tiff_stack(path, max_pages)]
+
+# opens the images of a multi-page .tif/.gel file as MappedImages, without reading their pixels
+def map_tiff_stack(path, max_pages=None):
+	data = map_file(path)
+	order = {b"II": "<", b"MM": ">"}.get(data[:2])
+	if order is None or struct.unpack(order + "H", data[2:4])[0] != 42:
+		raise IOError(path + " is not a TIFF file")
+	
+	images = []
+	ifd = struct.unpack(order + "I", data[4:8])[0]
+	while ifd and (max_pages is None or len(images) < max_pages):
+		image, ifd = tiff_page(data, order, ifd, path)
+		images.append(image)
+	return images
+
+# read-only bytes of a file which are only read where sliced: memory-mapped in CPython and read through the file
+# in Jython, which has no mmap module
+def map_file(path):
+	f = open(path, "rb")
+	try:
+		import mmap
+	except ImportError:
+		return FileBytes(f)
+	try:
+		try:
+			data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		except ValueError: # empty file
+			return b""
+	finally:
+		f.close()
+	if hasattr(data, "madvise"): # regions are read row by row in file order
+		data.madvise(mmap.MADV_SEQUENTIAL)
+	return data
+
+# slices of a file read on demand, shared by the lane threads
+class FileBytes(object):
+	def __init__(self, f):
+		self.file = f
+		self.lock = threading.Lock()
+		f.seek(0, 2)
+		self.size = f.tell()
+	
+	def __len__(self):
+		return self.size
+	
+	def __getitem__(self, index):
+		start, stop, step = index.indices(self.size)
+		self.lock.acquire()
+		try:
+			self.file.seek(start)
+			return self.file.read(max(0, stop - start))
+		finally:
+			self.lock.release()
+
+# the image of the image file directory at offset ifd and the offset of the next one (0 after the last page)
+def tiff_page(data, order, ifd, path):
+	entry_count = struct.unpack(order + "H", data[ifd:ifd + 2])[0]
+	tags = {}
+	for k in range(entry_count):
+		entry = ifd + 2 + 12*k
+		tag, field_type, count = struct.unpack(order + "HHI", data[entry:entry + 8])
+		if field_type not in TIFF_TYPES:
+			continue
+		fmt = order + TIFF_TYPES[field_type] * count
+		size = struct.calcsize(fmt)
+		offset = entry + 8 if size <= 4 else struct.unpack(order + "I", data[entry + 8:entry + 12])[0]
+		values = struct.unpack(fmt, data[offset:offset + size])
+		if field_type in (5, 10):
+			values = [values[2*m] / float(values[2*m + 1]) for m in range(count)]
+		tags[tag] = values
+	
+	width = tags[256][0]
+	height = tags[257][0]
+	bits = tags.get(258, (1,))[0]
+	samples = tags.get(277, (1,))[0]
+	if tags.get(259, (1,))[0] != 1:
+		raise IOError(path + ": compressed TIFF files are not supported")
+	code = TIFF_PIXEL_TYPES.get((bits, tags.get(339, (1,))[0]))
+	if code is None or samples not in (1, 3):
+		raise IOError(path + ": unsupported pixel type")
+	
+	# file offset of every row, rows_per_strip rows follow each other in every strip
+	row_size = width * samples * (bits // 8)
+	rows_per_strip = tags.get(278, (height,))[0]
+	strips = tags[273]
+	row_offsets = [strips[y // rows_per_strip] + (y % rows_per_strip) * row_size for y in range(height)]
+	
+	scale = None
+	if tags.get(MD_FILETAG, (0,))[0] == 2:
+		scale = tags.get(MD_SCALEPIXEL, (1.0,))[0]
+	max_value = 2**bits - 1 if code in "BHI" else None
+	
+	stat = os.stat(path)
+	source = (os.path.abspath(path), stat.st_size, stat.st_mtime, ifd)
+	next_ifd = struct.unpack(order + "I", data[ifd + 2 + 12*entry_count:ifd + 6 + 12*entry_count])[0]
+	return MappedImage(data, order, width, height, code, samples, row_offsets, max_value, scale, source), next_ifd
+
+# image of a .tif/.gel file whose pixels stay in the file, only the regions covered by the sampled lines are read
+# and decoded (see line_profile()), so gels larger than the memory can be analysed, the regions are decoded
+# the same way as by read_tiff()
+# max_value: largest possible raw value, found by reading the whole image once when None (e.g. float images)
+# scale: Molecular Dynamics .gel scale of the square root encoded values or None
+# source: (absolute path, size, modification time, directory offset) of the page in its file, hashed by image_hash()
+#         instead of the pixels so that the cache reads nothing more, or None to hash the pixels
+class MappedImage(object):
+	def __init__(self, data, order, width, height, code, samples, row_offsets, max_value=None, scale=None,
+				source=None):
+		self.data = data
+		self.source = source
+		self.width = width
+		self.height = height
+		self.code = code
+		self.samples = samples
+		self.row_offsets = row_offsets
+		self.scale = scale
+		self.pixel_size = samples * array(code).itemsize
+		self.swap = (order == "<") != (sys.byteorder == "little")
+		self.id = next(PixelImage.ids)
+		if max_value is None:
+			max_value = max(max(self.rawRegion(0, y, width, min(y + 256, height))) for y in range(0, height, 256))
+		self.max_value = max_value * max_value * scale if scale is not None else max_value
+	
+	def getID(self):
+		return self.id
+	
+	def getWidth(self):
+		return self.width
+	
+	def getHeight(self):
+		return self.height
+	
+	# undecoded samples of the rows y0 <= y < y1 and columns x0 <= x < x1, narrow regions (e.g. one lane) are read
+	# row by row, wide ones in blocks of the rows which follow each other in the file
+	def rawRegion(self, x0, y0, x1, y1):
+		start = x0 * self.pixel_size
+		size = (x1 - x0) * self.pixel_size
+		row_size = self.width * self.pixel_size
+		offsets = self.row_offsets
+		data = self.data
+		if 2*size < row_size:
+			chunks = [data[offset + start:offset + start + size] for offset in offsets[y0:y1]]
+		else:
+			chunks = []
+			y = y0
+			while y < y1:
+				end = y + 1
+				while end < y1 and offsets[end] == offsets[end - 1] + row_size:
+					end += 1
+				block = data[offsets[y]:offsets[end - 1] + row_size]
+				if size == row_size:
+					chunks.append(block)
+				else:
+					chunks.extend([block[k*row_size + start:k*row_size + start + size] for k in range(end - y)])
+				y = end
+		raw = array(self.code, b"".join(chunks))
+		if self.swap:
+			raw.byteswap()
+		return raw
+	
+	# PixelImage of the pixels x0 <= x < x1, y0 <= y < y1 clipped to the image and its origin
+	def region(self, x0, y0, x1, y1):
+		x0, x1 = max(0, x0), max(0, min(self.width, x1))
+		y0, y1 = max(0, y0), max(0, min(self.height, y1))
+		x1, y1 = max(x0, x1), max(y0, y1)
+		raw = self.rawRegion(x0, y0, x1, y1)
+		if self.samples == 3:
+			pixels = array("d", [(raw[k] + raw[k + 1] + raw[k + 2]) / 3.0 for k in range(0, len(raw), 3)])
+		elif raw.typecode != "d":
+			pixels = array("d", raw.tolist())
+		else:
+			pixels = raw
+		if self.scale is not None:
+			scale = self.scale
+			pixels = array("d", [v*v*scale for v in pixels])
+		image = PixelImage(x1 - x0, y1 - y0, pixels, self.max_value)
+		image.line_size = (self.width, self.height)
+		image.origin = (x0, y0)
+		return image
+	
+	# region covering the nearest pixels of every point of the lines (x1, y1, x2, y2), the points of
+	# PixelImage.getLine() lie between the end points
+	def lineRegion(self, lines):
+		xs = [x for line in lines for x in (line[0], line[2])]
+		ys = [y for line in lines for y in (line[1], line[3])]
+		return self.region(int(math.floor(min(xs) + 0.5)), int(math.floor(min(ys) + 0.5)),
+							int(math.floor(max(xs) + 0.5)) + 1, int(math.floor(max(ys) + 0.5)) + 1)
+	
+	def getLine(self, x1, y1, x2, y2):
+		region = self.lineRegion([(x1, y1, x2, y2)])
+		x0, y0 = region.origin
+		return region.getLine(x1 - x0, y1 - y0, x2 - x0, y2 - y0)
+
+
+# names of a parameter set, the keyword arguments of measure_gel() after the image
+PARAMETER_NAMES = ["first_x", "first_y", "lane_length", "lane_sep", "lane_width", "lane_count", "lane_direction",
+					"bg_x", "bg_sep", "selections", "lane_angle", "lane_bend"]
+GEL_EXTENSIONS = (".tif", ".tiff", ".gel")
+
+# fills in the values missing from a parameter set (or set to None) the same way the windows do
+def complete_parameters(params):
+	params = dict(params)
+	for name, title in GEOMETRY_FIELDS:
+		if params.get(name) is None:
+			params[name] = ANALYSIS_DEFAULTS[title]
+	if params.get("lane_direction") is None:
+		params["lane_direction"] = "vertical"
+	if params.get("lane_angle") is None:
+		params["lane_angle"] = 0.0
+	if params.get("lane_bend") is None:
+		params["lane_bend"] = []
+	bg_x, bg_sep = default_background(params["first_x"], params["lane_length"], params["lane_sep"],
+									params["lane_count"], params["lane_direction"])
+	if params.get("bg_x") is None:
+		params["bg_x"] = bg_x
+	if params.get("bg_sep") is None:
+		params["bg_sep"] = bg_sep
+	if not params.get("selections"):
+		params["selections"] = [[0, params["lane_length"]]]
+	return params
+
+# window settings stored in a recipe besides the parameter set: the gel analysed at its native bit depth and
+# the lane overview with auto-adjusted contrast (display only)
+RECIPE_SETTINGS = ["native", "contrast_enhanced"]
+RECIPE_EXTENSION = ".emsa.json"
+
+# parameter set stored as a JSON object with the keys of PARAMETER_NAMES, missing keys take the defaults,
+# the settings of a recipe are skipped so that recipes can be used as parameter sets
+def load_parameters(path):
+	f = open(path)
+	try:
+		params = json.load(f)
+	finally:
+		f.close()
+	unknown = [name for name in params if name not in PARAMETER_NAMES and name not in RECIPE_SETTINGS]
+	if unknown:
+		raise ValueError(path + ": unknown parameters " + ", ".join(sorted(unknown)))
+	return dict((name, value) for name, value in params.items() if name in PARAMETER_NAMES)
+
+def save_parameters(path, params):
+	write_file(path, json.dumps(dict((name, params[name]) for name in PARAMETER_NAMES), indent=1, sort_keys=True))
+
+# the recipe of a gel is kept next to it, gel.tif -> gel.emsa.json
+def recipe_path(path):
+	return os.path.splitext(path)[0] + RECIPE_EXTENSION
+
+# recipe: complete parameter set and window settings of one analysed gel, replayed by the "Apply recipe" button
+# or by the --recipes option
+def save_recipe(path, params, native=False, contrast_enhanced=False):
+	recipe = dict((name, params[name]) for name in PARAMETER_NAMES)
+	recipe.update({"native": bool(native), "contrast_enhanced": bool(contrast_enhanced)})
+	write_file(path, json.dumps(recipe, indent=1, sort_keys=True))
+
+# returns the parameter set and a dict of the RECIPE_SETTINGS of a recipe
+def load_recipe(path):
+	f = open(path)
+	try:
+		recipe = json.load(f)
+	finally:
+		f.close()
+	return load_parameters(path), dict((name, bool(recipe.get(name, False))) for name in RECIPE_SETTINGS)
+
+# writes through a temporary file, so an interrupted run never leaves a truncated file behind
+def write_file(path, text):
+	directory = os.path.dirname(path)
+	if directory and not os.path.isdir(directory):
+		try:
+			os.makedirs(directory)
+		except OSError: # created by another worker meanwhile
+			pass
+	temp_path = path + ".part"
+	f = open(temp_path, "w")
+	try:
+		f.write(text)
+	finally:
+		f.close()
+	if os.path.exists(path):
+		os.remove(path)
+	os.rename(temp_path, path)
+
+# expands folders to the gel files they contain
+def gel_files(paths):
+	files = []
+	for path in paths:
+		if os.path.isdir(path):
+			files.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+								if name.lower().endswith(GEL_EXTENSIONS)))
+		else:
+			files.append(path)
+	return files
+
+def results_path(path, output_dir=None):
+	directory = output_dir or os.path.dirname(os.path.abspath(path))
+	return os.path.join(directory, os.path.splitext(os.path.basename(path))[0] + ".txt")
+
+# per-file checkpoint written once the results of a gel are complete
+def checkpoint_path(path, output_dir=None):
+	directory = output_dir or os.path.dirname(os.path.abspath(path))
+	return os.path.join(directory, ".emsa_checkpoints", os.path.basename(path) + ".json")
+
+def checkpoint_record(path, params, native, options=()):
+	return {"image": os.path.abspath(path), "modified": os.path.getmtime(path), "parameters": params, "native": native,
+			"options": sorted(options)}
+
+# True if a previous run already analysed the unchanged gel with the same parameters
+def is_checkpointed(path, params, output_dir, native, options=()):
+	try:
+		f = open(checkpoint_path(path, output_dir))
+		try:
+			record = json.load(f)
+		finally:
+			f.close()
+	except (IOError, OSError, ValueError):
+		return False
+	# compare through JSON so that tuples and lists of the parameter set are equal
+	expected = json.loads(json.dumps(checkpoint_record(path, params, native, options)))
+	return record == expected and os.path.exists(results_path(path, output_dir))
+
+# analyse_gel() of a task of run_batch() followed by the STAGE_STATS.summary() of the gel when it ran in a worker
+# process (None otherwise), stats of the task: None or (pid of run_batch(), trace_memory) while recording
+def batch_worker(task):
+	stats = task[-1]
+	in_process = stats is not None and os.getpid() != stats[0]
+	if in_process: # the stages of the previous gel of this worker were returned with it
+		STAGE_STATS.clear()
+		STAGE_STATS.enable(True, stats[1])
+	return analyse_gel(task[:-1]) + ((STAGE_STATS.summary() if in_process else None),)
+
+# analyses all slices of one gel of a batch with the same parameters, returns (path, None, checkpoint, store records)
+# or (path, error message, None, None)
+# so one bad file does not stop the batch, the checkpoint is written by run_batch() once the results are stored
+# options: "detect_lanes" to find the lane geometry in the gel (parameters given in params take precedence over
+# the detected ones), "detect_bands" to propose the selection areas, "box_sums" to sum the selection areas as
+# rectangles of the gel instead of along the lane profiles, "save_recipes" to save the parameters used as the
+# recipe of the gel and "store" to return the records of store_record() for a ResultStore (one per slice)
+# cache: ResultCache of the lane profiles and backgrounds or None
+@stage("analyse_gel")
+def analyse_gel(task):
+	path, params, output_dir, native, options, cache = task
+	try:
+		imps, labels = load_stack(path, native)
+		gel_params = params
+		if "detect_lanes" in options:
+			lanes = detect_lanes(imps[0], params.get("lane_direction") or "vertical", cache)
+			if lanes is None:
+				raise ValueError("no regularly spaced lanes found")
+			lanes.update((name, value) for name, value in params.items() if value is not None)
+			gel_params = complete_parameters(lanes)
+		results = measure_stack(imps, cache=cache, **gel_params)
+		slice_sums = [result["sums"] for result in results]
+		selections = gel_params["selections"]
+		if "detect_bands" in options:
+			selections = detect_stack_bands([result["adj_profiles"] for result in results])
+			if not selections:
+				raise ValueError("no bands found")
+			slice_sums = [measure_selections(result["adj_prefix_sums"], selections) for result in results]
+		if "box_sums" in options:
+			if not is_straight(gel_params["lane_angle"], gel_params["lane_bend"]):
+				raise ValueError("box sums need straight lanes")
+			y_origin = plane_origin(gel_params["first_y"], gel_params["lane_width"], gel_params["lane_direction"])
+			tables = [SummedAreaTable(imp, result["plane"], y_origin) for imp, result in zip(imps, results)]
+			boxes = lane_boxes(gel_params["first_x"], gel_params["first_y"], gel_params["lane_sep"],
+								gel_params["lane_width"], gel_params["lane_count"], gel_params["lane_direction"], selections)
+			slice_sums = [measure_boxes(table, boxes) for table in tables]
+		titled = selections if "detect_bands" in options else None
+		if len(imps) == 1:
+			write_file(results_path(path, output_dir), format_results(slice_sums[0], titled))
+		else:
+			write_file(results_path(path, output_dir), format_stack_results(slice_sums, labels, titled))
+		if "save_recipes" in options:
+			save_recipe(recipe_path(path), dict(gel_params, selections=selections), native)
+		records = []
+		if "store" in options:
+			analysed = time.time()
+			for k in range(len(imps)):
+				if "box_sums" in options:
+					method, raw_sums = "box", measure_boxes(tables[k], boxes, raw=True)
+				else:
+					method, raw_sums = "profile", measure_selections(prefix_sums(results[k]["profiles"]), selections)
+				records.append(store_record(path, imps[k], dict(gel_params, selections=selections), native, method,
+											results[k]["plane"], selections, raw_sums, slice_sums[k], k + 1, labels[k],
+											analysed))
+		return path, None, checkpoint_record(path, params, native, options), records
+	except Exception as error:
+		return path, "%s: %s" % (type(error).__name__, error), None, None
+
+def cpu_count():
+	try:
+		from java.lang import Runtime
+		return Runtime.getRuntime().availableProcessors()
+	except ImportError:
+		import multiprocessing
+		return multiprocessing.cpu_count()
+
+# threads sampling the lanes of one gel, Jython threads run in parallel but CPython threads hold the GIL
+LANE_THREADS = cpu_count() if sys.platform.startswith("java") else 1
+
+# yields function(item) for every item as the results complete, on a process pool in CPython
+# and on a thread pool in Jython, whose threads run in parallel but which has no multiprocessing
+def parallel_map(function, items, jobs, processes=True):
+	if jobs <= 1 or len(items) <= 1:
+		for item in items:
+			yield function(item)
+		return
+	multiprocessing = None
+	if processes:
+		try:
+			import multiprocessing
+		except ImportError:
+			pass
+	if multiprocessing is not None:
+		pool = multiprocessing.Pool(min(jobs, len(items)))
+		try:
+			for result in pool.imap_unordered(function, items):
+				yield result
+		finally:
+			pool.terminate()
+		return
+	
+	try:
+		from Queue import Queue, Empty
+	except ImportError:
+		from queue import Queue, Empty
+	tasks = Queue()
+	results = Queue()
+	for item in items:
+		tasks.put(item)
+	def work():
+		while True:
+			try:
+				item = tasks.get_nowait()
+			except Empty:
+				return
+			try:
+				results.put((True, function(item)))
+			except Exception as error:
+				results.put((False, error))
+	for k in range(min(jobs, len(items))):
+		thread = threading.Thread(target=work)
+		thread.daemon = True
+		thread.start()
+	for item in items:
+		ok, result = results.get()
+		if not ok:
+			raise result
+		yield result
+
+# [function(item) for item in items] computed on up to jobs threads
+def thread_map(function, items, jobs):
+	results = [None] * len(items)
+	indexed = lambda pair: (pair[0], function(pair[1]))
+	for i, result in parallel_map(indexed, list(enumerate(items)), jobs, processes=False):
+		results[i] = result
+	return results
+
+# analyses all gels with one parameter set, gels with a checkpoint from a previous run are skipped when resuming
+# options: see analyse_gel(), with "detect_lanes" the missing parameters are completed for every gel after its
+# lanes are detected, with "recipes" every gel with a recipe is analysed with its parameter set updated by the
+# values given in params (and at native bit depth if either asks for it)
+# unchanged stages of gels analysed before are read from the cache
+# store: ResultStore receiving the results, inserted in bulk every STORE_BATCH gels (the checkpoints of the gels
+# are written once their results are stored)
+# the stages recorded by worker processes are merged into STAGE_STATS
+# returns the number of failed gels
+def run_batch(paths, params, output_dir=None, native=False, jobs=1, resume=True, log=None, options=(), cache=None,
+			store=None):
+	if log is None:
+		log = lambda message: sys.stdout.write(message + "\n")
+	if store is not None:
+		options = list(options) + ["store"]
+	stats = (os.getpid(), STAGE_STATS.trace_memory) if STAGE_STATS.enabled else None
+	tasks = []
+	for path in paths:
+		gel_params = params
+		gel_native = native
+		if "recipes" in options and os.path.exists(recipe_path(path)):
+			gel_params, settings = load_recipe(recipe_path(path))
+			gel_params.update((name, value) for name, value in params.items() if value is not None)
+			gel_native = native or settings["native"]
+		if "detect_lanes" not in options:
+			gel_params = complete_parameters(gel_params)
+		if resume and is_checkpointed(path, gel_params, output_dir, gel_native, options):
+			log("skipped " + path + " (done in a previous run)")
+		else:
+			tasks.append((path, gel_params, output_dir, gel_native, options, cache, stats))
+	
+	failed = 0
+	done = 0
+	pending = [] # (path, checkpoint, store records) of finished gels whose results are not stored yet
+	try:
+		for path, error, checkpoint, records, stages in parallel_map(batch_worker, tasks, jobs):
+			done += 1
+			if stages:
+				STAGE_STATS.merge(stages)
+			if error is None:
+				log("[%d/%d] %s" % (done, len(tasks), path))
+				pending.append((path, checkpoint, records))
+			else:
+				failed += 1
+				log("[%d/%d] %s failed, %s" % (done, len(tasks), path, error))
+			if store is None or len(pending) >= STORE_BATCH:
+				store_results(pending, output_dir, store)
+	finally: # an interrupted batch keeps the gels finished so far
+		store_results(pending, output_dir, store)
+	return failed
+
+# results inserted into a ResultStore at once by run_batch()
+STORE_BATCH = 100
+
+# inserts the pending results of run_batch() into the store and checkpoints their gels, pending is emptied
+@stage("store_results")
+def store_results(pending, output_dir, store):
+	if not pending:
+		return
+	if store is not None:
+		store.addGels([record for path, checkpoint, records in pending for record in records])
+	for path, checkpoint, records in pending:
+		write_file(checkpoint_path(path, output_dir), json.dumps(checkpoint))
+	del pending[:]
+
+
+# command line entry point of the headless engine, e.g.
+#   python emsa_script.py gel1.tif gel2.gel --first-x 815 --area 100:300 --area 300:600
+#   python emsa_script.py gels/ --parameters emsa_parameters.json --jobs 8
+#   ImageJ-linux64 --headless --jython emsa_script.py gel1.tif ...
+def main(argv):
+	import argparse
+	parser = argparse.ArgumentParser(prog="emsa_script.py",
+									description="Headless EMSA analysis, writes the peak sums of every lane and selection area "
+												"to a .txt file next to each image.")
+	parser.add_argument("images", nargs="+", help=".tif or .gel files or folders containing them")
+	parser.add_argument("--parameters", help="JSON file with a saved parameter set, options given on the command line "
+											"take precedence")
+	parser.add_argument("--save-parameters", metavar="PATH", help="save the resulting parameter set as JSON")
+	parser.add_argument("--direction", dest="lane_direction", choices=["vertical", "horizontal"],
+						help="lane direction (default: vertical)")
+	parser.add_argument("--first-x", type=int, help="default: %d" % ANALYSIS_DEFAULTS["First lane x"])
+	parser.add_argument("--first-y", type=int, help="default: %d" % ANALYSIS_DEFAULTS["First lane y"])
+	parser.add_argument("--lane-length", type=int, help="default: %d" % ANALYSIS_DEFAULTS["Lane length"])
+	parser.add_argument("--lane-sep", type=int, help="default: %d" % ANALYSIS_DEFAULTS["Lane separation"])
+	parser.add_argument("--lane-width", type=int, help="default: %d" % ANALYSIS_DEFAULTS["Lane width"])
+	parser.add_argument("--lane-count", type=int, help="default: %d" % ANALYSIS_DEFAULTS["Lane count"])
+	parser.add_argument("--lane-angle", type=float,
+						help="rotation of the lanes in degrees, clockwise, about the start of the first lane (default: 0)")
+	parser.add_argument("--lane-bend", type=parse_bend, metavar="SHIFTS",
+						help="sideways shifts of the lane centerlines in pixels at evenly spaced points from the start "
+							"to the end of the lanes, e.g. \"0,4,0\" (default: straight lanes)")
+	parser.add_argument("--bg-x", type=int, help="left background sample x (default as in the background window)")
+	parser.add_argument("--bg-sep", type=int, help="background sample separation (default as in the background window)")
+	parser.add_argument("--area", action="append", metavar="LEFT:RIGHT",
+						help="selection area given by its peak sum borders, may be repeated (default: whole lane)")
+	parser.add_argument("--detect-lanes", action="store_true",
+						help="detect the first lane position, lane separation, lane count and lane width in every gel, "
+							"values given explicitly take precedence")
+	parser.add_argument("--detect-bands", action="store_true",
+						help="propose one selection area per band found in every gel instead of the --area options, "
+							"the area borders are added to the column titles of the results")
+	parser.add_argument("--box-sums", action="store_true",
+						help="sum every selection area as a rectangle of the gel, i.e. the total intensity instead of "
+							"the sum of the profile averaged over the lane width")
+	parser.add_argument("--recipes", action="store_true",
+						help="analyse every gel with the recipe saved next to it (gel.emsa.json), options given "
+							"explicitly take precedence")
+	parser.add_argument("--save-recipes", action="store_true",
+						help="save the parameters each gel was analysed with as its recipe, including detected lanes "
+							"and bands")
+	parser.add_argument("--output-dir", help="directory for the results instead of the image directory")
+	parser.add_argument("--store", metavar="PATH",
+						help="also append the results to this SQLite database (created if missing), one row per gel, "
+							"lane and selection area with the area borders, background plane and raw and "
+							"background-subtracted sums")
+	parser.add_argument("--native", action="store_true",
+						help="in ImageJ, analyse the native bit depth instead of the RGB conversion used by the windows")
+	parser.add_argument("--jobs", type=int, default=cpu_count(), help="gels analysed in parallel (default: %(default)s)")
+	parser.add_argument("--cache-dir", default=RESULT_CACHE_DIR,
+						help="directory keeping the lane profiles and backgrounds of analysed gels, so that analysing a gel "
+							"again with new selection areas samples nothing (default: %(default)s)")
+	parser.add_argument("--cache-size", type=int, default=256, metavar="MB",
+						help="size above which the least recently used cache entries are removed (default: %(default)s)")
+	parser.add_argument("--no-cache", action="store_true", help="neither read nor write the cache")
+	parser.add_argument("--restart", action="store_true", help="analyse again gels finished in a previous run")
+	parser.add_argument("--stage-stats", metavar="PATH",
+						help="record the wall time, call count and bytes allocated (in ImageJ) of every analysis stage, "
+							"print them and save them to this JSON file")
+	parser.add_argument("--stage-memory", action="store_true",
+						help="with --stage-stats in plain Python, also trace the bytes allocated by every stage, which "
+							"slows the analysis down several times")
+	args = parser.parse_args(argv)
+	if args.stage_stats:
+		STAGE_STATS.enable(trace_memory=args.stage_memory)
+	
+	params = {}
+	if args.parameters:
+		params.update(load_parameters(args.parameters))
+	for name in PARAMETER_NAMES:
+		if getattr(args, name, None) is not None:
+			params[name] = getattr(args, name)
+	if args.area:
+		params["selections"] = [[int(bound) for bound in area.split(":")] for area in args.area]
+	if args.save_parameters:
+		save_parameters(args.save_parameters, complete_parameters(params))
+	
+	options = [name for name in ["detect_lanes", "detect_bands", "box_sums", "recipes", "save_recipes"] if getattr(args, name)]
+	cache = None if args.no_cache else ResultCache(args.cache_dir, args.cache_size * 1024 * 1024)
+	store = ResultStore(args.store) if args.store else None
+	try:
+		failed = run_batch(gel_files(args.images), params, args.output_dir, args.native, args.jobs, not args.restart,
+							options=options, cache=cache, store=store)
+	finally:
+		if store is not None:
+			store.close()
+		if args.stage_stats:
+			sys.stdout.write(STAGE_STATS.report() + "\n")
+			STAGE_STATS.save(args.stage_stats)
+	return 1 if failed else 0
+
 def selection_window():
 	try:
 		IJ.getImage()
@@ -496,25 +2823,37 @@ def selection_window():
 	panel = JPanel()
 	panel.setBorder(BorderFactory.createEmptyBorder(10, 10, 10, 10))
 	gb = GridBagLayout()
-  	panel.setLayout(gb)  
-  	gc = GBC()
-  	
-  	gc.gridx = 0
-  	gc.gridy = 0
-  	gc.gridwidth = 1 
-  	gc.gridheight = 1
-  	gc.fill = GBC.NONE
-  	
-  	textfields = {}
-  	field_listener = FieldListener(textfields, frame)
-  	
-  	analysis_defaults = {"First lane x": 815, "First lane y": 50, "Lane length": 950,
-					"Lane separation": 165, "Lane width": 50, "Lane count": 5}
-  	
-  	button = JButton("Auto-adjust contrast", actionPerformed=field_listener.enhanceContrast)
+	panel.setLayout(gb)  
+	gc = GBC()
+	
+	gc.gridx = 0
+	gc.gridy = 0
+	gc.gridwidth = 1 
+	gc.gridheight = 1
+	gc.fill = GBC.NONE
+	
+	textfields = {}
+	field_listener = FieldListener(textfields, frame)
+	
+	
+	button = JButton("Auto-adjust contrast", actionPerformed=field_listener.enhanceContrast)
 	gb.setConstraints(button, gc)
 	panel.add(button)
 	
+	gc.gridx = 1
+	checkbox = JCheckBox("Keep native bit depth", actionPerformed=field_listener.switchBitDepth)
+	checkbox.setToolTipText("Analyse the original 16-bit/32-bit values instead of an 8-bit RGB copy")
+	gb.setConstraints(checkbox, gc)
+	panel.add(checkbox)
+	field_listener.native_checkbox = checkbox
+	gc.gridy += 1
+	
+	checkbox = JCheckBox("Record stage timings", STAGE_STATS.enabled, actionPerformed=field_listener.recordStages)
+	checkbox.setToolTipText("Time the analysis steps and measure their memory, shown in the Log when saving")
+	gb.setConstraints(checkbox, gc)
+	panel.add(checkbox)
+	gc.gridx = 0
+	
 	gc.gridy += 1
 	
 	label = JLabel("<html><b>Lane direction</b></html>")
@@ -538,6 +2877,7 @@ def selection_window():
 	button_group = ButtonGroup()
 	button_group.add(vert_button)
 	button_group.add(hor_button)
+	field_listener.direction_buttons = {"vertical": vert_button, "horizontal": hor_button}
 	gc.gridx = 0
 	gc.gridy += 1
 	
@@ -550,7 +2890,8 @@ def selection_window():
 	gc.gridwidth = 1
 	gc.gridy += 1
 
-	for title in ["First lane x", "First lane y", "Lane length", "Lane separation", "Lane width", "Lane count"]:  
+	for title in ["First lane x", "First lane y", "Lane length", "Lane separation", "Lane width", "Lane count",
+				"Lane angle", "Lane bend"]:  
 	    gc.gridx = 0  
 	    gc.anchor = GBC.EAST  
 	    label = JLabel(title + ": ")  
@@ -559,7 +2900,7 @@ def selection_window():
 	    
 	    gc.gridx = 1
 	    gc.anchor = GBC.WEST
-	    text = str(analysis_defaults[title]) 
+	    text = str(ANALYSIS_DEFAULTS[title]) 
 	    textfield = JTextField(text, 10)
 	    textfields[title] = textfield
 	    gb.setConstraints(textfield, gc)
@@ -568,10 +2909,23 @@ def selection_window():
 
 	    gc.gridy += 1
 
+	button = JButton("Auto-detect lanes", actionPerformed=field_listener.detectLanes)
+	button.setToolTipText("Find the lane position, separation, count and width from the gel")
+	gb.setConstraints(button, gc)
+	panel.add(button)
+	field_listener.detect_button = button
+	
 	gc.gridx = 1
+	button = JButton("Apply recipe", actionPerformed=field_listener.applyRecipe)
+	button.setToolTipText("Analyse the gel with the recipe saved with an earlier measurement (gel.emsa.json)")
+	gb.setConstraints(button, gc)
+	panel.add(button)
+	gc.gridy += 1
+	
 	button = JButton(">> Background selection", actionPerformed=field_listener.runAnalysis)
 	gb.setConstraints(button, gc)
 	panel.add(button)
+	field_listener.analysis_button = button
 	frame.getContentPane().add(panel)
 	frame.setLocationRelativeTo(None)
 	frame.pack()
@@ -588,41 +2942,36 @@ def background_window(frame, field_listener):
 	panel = JPanel()
 	panel.setBorder(BorderFactory.createEmptyBorder(10, 10, 10, 10))
 	gb = GridBagLayout()
-  	panel.setLayout(gb)  
-  	gc = GBC()
-  	
-  	gc.gridx = 0
-  	gc.gridy = 0
-  	gc.gridwidth = 1
-  	gc.gridheight = 1
-  	gc.fill = GBC.NONE
-  	
-  	gc.gridwidth = 2
-  	label_text = "Place the black lines on the lane overview image so that they are located outside of any gel lane, one to the left from your selection lanes, one to the right. These lines are then used to fit a background plane, which will be subtracted from the data. You may see a preview of the background for the two lines in the gel profile graph."
-  	label = JLabel("<html>" + label_text + "</html>")
-  	label = JTextArea(label_text, 6, 30)
-  	label.setLineWrap(True)
-  	label.setWrapStyleWord(True)
-  	label.setEditable(False)
-  	gb.setConstraints(label, gc)
-  	panel.add(label)
-  	
-  	gc.gridwidth = 1
-  	gc.gridy += 1
-  	
-  	textfields = {}
+	panel.setLayout(gb)  
+	gc = GBC()
+	
+	gc.gridx = 0
+	gc.gridy = 0
+	gc.gridwidth = 1
+	gc.gridheight = 1
+	gc.fill = GBC.NONE
+	
+	gc.gridwidth = 2
+	label_text = "Place the black lines on the lane overview image so that they are located outside of any gel lane, one to the left from your selection lanes, one to the right. These lines are then used to fit a background plane, which will be subtracted from the data. You may see a preview of the background for the two lines in the gel profile graph."
+	label = JLabel("<html>" + label_text + "</html>")
+	label = JTextArea(label_text, 6, 30)
+	label.setLineWrap(True)
+	label.setWrapStyleWord(True)
+	label.setEditable(False)
+	gb.setConstraints(label, gc)
+	panel.add(label)
+	
+	gc.gridwidth = 1
+	gc.gridy += 1
+	
+	textfields = {}
 	bg_listener = BackgroundListener(textfields, frame, field_listener)
 	
-	if field_listener.lane_dir == "vertical":
-		background_defaults = {
-			"Left background sample x": int(field_listener.first_x - 0.5 * field_listener.lane_sep),
-			"Background sample separation": field_listener.lane_count * field_listener.lane_sep
-			}
-	else:
-		background_defaults = {
-			"Left background sample x": int(field_listener.first_x - 0.5 * field_listener.lane_sep),
-			"Background sample separation": field_listener.lane_length + field_listener.lane_sep}
-		
+	bg_x, bg_sep = default_background(field_listener.first_x, field_listener.lane_length, field_listener.lane_sep,
+									field_listener.lane_count, field_listener.lane_dir)
+	if field_listener.recipe is not None:
+		bg_x, bg_sep = field_listener.recipe["bg_x"], field_listener.recipe["bg_sep"]
+	background_defaults = {"Left background sample x": bg_x, "Background sample separation": bg_sep}
 
 	for title in ["Left background sample x", "Background sample separation"]:  
 	    gc.gridx = 0  
@@ -650,6 +2999,7 @@ def background_window(frame, field_listener):
 	button = JButton(">> Remove background", actionPerformed=bg_listener.removeBackground)
 	gb.setConstraints(button, gc)
 	panel.add(button)
+	bg_listener.remove_button = button
 	frame.getContentPane().add(panel)
 	frame.setLocationRelativeTo(None)
 	frame.pack()
@@ -658,6 +3008,8 @@ def background_window(frame, field_listener):
 	bg_listener.panel = panel
 	bg_listener.updateFields()
 	bg_listener.backgroundPreview()
+	if field_listener.recipe is not None:
+		bg_listener.removeBackground(None)
 
 
 def measurement_window(frame, background_listener):
@@ -668,16 +3020,16 @@ def measurement_window(frame, background_listener):
 	panel = JPanel()
 	panel.setBorder(BorderFactory.createEmptyBorder(10, 10, 10, 10))
 	gb = GridBagLayout()
-  	panel.setLayout(gb)  
-  	gc = GBC()
+	panel.setLayout(gb)  
+	gc = GBC()
 
-  	gc.gridx = 0
-  	gc.gridy = 0
-  	gc.gridwidth = 1 
-  	gc.gridheight = 1
-  	gc.fill = GBC.NONE
+	gc.gridx = 0
+	gc.gridy = 0
+	gc.gridwidth = 1 
+	gc.gridheight = 1
+	gc.fill = GBC.NONE
 
-  	textfields = {}
+	textfields = {}
 	result_fields = []
 	ms_listener = MeasurementListener(textfields, result_fields, frame, background_listener)
 	
@@ -693,6 +3045,13 @@ def measurement_window(frame, background_listener):
 	panel.add(button)
 	gc.gridy += 1
 	
+	button = JButton("Detect bands", actionPerformed=ms_listener.detectBandsEvent)
+	button.setToolTipText("Replace the selection areas by one area around each band found in the lanes")
+	gb.setConstraints(button, gc)
+	panel.add(button)
+	gc.gridx = 0
+	gc.gridy += 1
+	
 
 	measurement_defaults = {
 		"Left peak sum border": 0,
@@ -745,6 +3104,7 @@ def measurement_window(frame, background_listener):
 	button = JButton("Save measurement", actionPerformed=ms_listener.saveMeasurement)
 	gb.setConstraints(button, gc)
 	panel.add(button)
+	ms_listener.save_button = button
 
 	frame.getContentPane().add(panel)
 	frame.setLocationRelativeTo(None)
@@ -753,6 +3113,13 @@ def measurement_window(frame, background_listener):
 	
 	ms_listener.updateFields()
 	ms_listener.sumProfiles()
+	if ms_listener.fieldListener.recipe is not None:
+		ms_listener.setSelectionAreas(ms_listener.fieldListener.recipe["selections"])
+		ms_listener.fieldListener.recipe = None
 	
 
-selection_window()
+if __name__ in ("__main__", "__builtin__"):
+	# without ImageJ there are no windows, main() then prints the usage and exits with an error
+	if len(getattr(sys, "argv", [])) > 1 or IJ is None:
+		sys.exit(main(sys.argv[1:]))
+	selection_window()